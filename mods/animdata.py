@@ -2,10 +2,12 @@
 mods.animdata
 """
 from collections import namedtuple
+import bisect
 import sys
 
 import maya.api.OpenMaya as om
 import maya.api.OpenMayaAnim as oma
+import maya.api.OpenMayaUI as omui2
 import maya.cmds as cmds
 
 if sys.version_info >= (3, 0):
@@ -16,7 +18,12 @@ else:
     import utils as utils
 
 anim_cache = None
+tick_modifier = None
 curve_key_values = {}
+added_keys = {}  # times of the keys added by the last prepare, per curve
+
+# times closer than this are considered the same key
+TIME_TOLERANCE = 1e-6
 
 KeyGroup = namedtuple('KeyGroup', 'key_index value prev_value next_value default_value tangent_points has_two_segments')
 
@@ -25,32 +32,44 @@ def maya_useNewAPI():
     pass
 
 
+def get_target_curves():
+    """
+    Gets the curves to tween from the selection. Selected curves are used in the graph editor and dope sheet,
+    otherwise the curves of the selected objects.
+    
+    :return: Tuple of curves and plugs, plugs is None for selected curves
+    :rtype: (list of maya.api.OpenMaya.MObject, list of maya.api.OpenMaya.MPlug or None)
+    """
+    if utils.is_graph_editor_or_dope_sheet():
+        return utils.get_selected_anim_curves(), None
+    
+    nodes = utils.get_selected_objects()
+    return utils.get_anim_curves_from_objects(nodes)
+
+
 def prepare(mode):
     """
     Prepares the dictionary of animation curves along with values before/after required to interpolate.
     """
     global anim_cache
     global curve_key_values
+    global added_keys
     
     # get curves
-    if utils.is_graph_editor_or_dope_sheet():
-        curves = utils.get_selected_anim_curves()
-        plugs = None
-    else:
-        nodes = utils.get_selected_objects()
-        curves, plugs = utils.get_anim_curves_from_objects(nodes)
+    curves, plugs = get_target_curves()
     
     # get prev and next values, so we can use them to blend while dragging slider
     is_default = bool(mode == options.BlendingMode.default)
     is_curve_tangent = bool(mode == options.BlendingMode.curve)
     
     curve_key_values = {}
+    added_keys = {}
     time_range = utils.get_time_slider_range()
     unit = om.MTime.uiUnit()
     mtime_range = (om.MTime(time_range[0], unit), om.MTime(time_range[1], unit))
     
-    for plug_idx, curve_node in enumerate(curves):
-        curve_fn = oma.MFnAnimCurve(curve_node.object())
+    for plug_idx, curve_obj in enumerate(curves):
+        curve_fn = oma.MFnAnimCurve(curve_obj)
         
         default_val = None
         if is_default:
@@ -95,32 +114,7 @@ def prepare(mode):
         
         elif selected_keys is not None:
             # keys selected in graph editor or dope sheet
-            index_group = []
-            groups = []
-            
-            # find groups of consecutive key indices
-            index_group.append(selected_keys[0])
-            for i in range(1, len(selected_keys)):
-                if selected_keys[i] - selected_keys[i - 1] < 2:
-                    index_group.append(selected_keys[i])
-                else:
-                    groups.append(index_group)
-                    index_group = [selected_keys[i]]
-            
-            # append last iteration
-            groups.append(index_group)
-            
-            for grp in groups:
-                prev_index = max(0, grp[0] - 1)
-                next_index = min(grp[-1] + 1, curve_fn.numKeys - 1)
-                
-                for idx in grp:
-                    add_to_key_group(curve_fn, idx, prev_index, next_index, key_group)
-                
-                if is_curve_tangent:
-                    for idx in grp:
-                        add_tangent_points_to_key_group(key_group, curve_fn, prev_index, next_index, index=idx)
-            
+            add_index_groups_to_key_group(curve_fn, selected_keys, key_group, is_curve_tangent)
             curve_key_values[curve_fn] = key_group
         else:
             # no time range or keys selected
@@ -148,6 +142,7 @@ def prepare(mode):
                 # add new key
                 value = curve_fn.evaluate(mtime_range[0])
                 current_index = curve_fn.addKey(mtime_range[0], value, change=anim_cache)
+                added_keys[curve_fn] = [mtime_range[0]]
                 
                 next_index = min(curve_fn.numKeys - 1, next_index + 1)
                 
@@ -159,6 +154,248 @@ def prepare(mode):
             curve_key_values[curve_fn] = key_group
 
 
+def prepare_times(curve_fns, times, mode, plugs=None):
+    """
+    Prepares the dictionary of animation curves for explicit curves and times, without reading any UI state.
+    
+    All times of a curve are resolved against one snapshot of its keys, so each time blends between the original keys
+    before and after it, and the times do not affect each other. Missing keys are added in one batch per curve.
+    
+    :param curve_fns: Animation curves
+    :type curve_fns: list of maya.api.OpenMayaAnim.MFnAnimCurve
+    :param times: Times in the current time unit
+    :type times: list of float
+    :param mode: Blending mode
+    :type mode: options.BlendingMode.Mode
+    :param plugs: Plugs the curves are connected to, used to find default values
+    :type plugs: list of maya.api.OpenMaya.MPlug or None
+    """
+    global curve_key_values
+    global added_keys
+    
+    is_default = bool(mode == options.BlendingMode.default)
+    is_curve_tangent = bool(mode == options.BlendingMode.curve)
+    
+    curve_key_values = {}
+    added_keys = {}
+    times = sorted(set(times))
+    unit = om.MTime.uiUnit()
+    
+    for plug_idx, curve_fn in enumerate(curve_fns):
+        num_keys = curve_fn.numKeys
+        if num_keys == 0 or not times:
+            continue
+        
+        default_val = None
+        if is_default:
+            if plugs:
+                default_val = utils.get_attribute_default_value(plugs[plug_idx])
+            else:
+                default_val = utils.get_anim_curve_default_value(curve_fn)
+        
+        key_group = KeyGroup(key_index=[],
+                             value=[],
+                             default_value=default_val,
+                             prev_value=[],
+                             next_value=[],
+                             tangent_points=[],
+                             has_two_segments=[])
+        
+        # snapshot of the keys before anything is added
+        key_times = [curve_fn.input(i).asUnits(unit) for i in range(num_keys)]
+        key_values = [curve_fn.value(i) for i in range(num_keys)]
+        
+        new_times = om.MTimeArray()
+        new_values = om.MDoubleArray()
+        entries = []
+        
+        for t in times:
+            index = bisect.bisect_left(key_times, t - TIME_TOLERANCE)
+            prev_index = max(0, index - 1)
+            
+            if index < num_keys and abs(key_times[index] - t) <= TIME_TOLERANCE:
+                # key exists, so two curve tangent segments
+                next_index = min(num_keys - 1, index + 1)
+                value = key_values[index]
+                tangent_index = index
+            else:
+                # no key yet, so a single segment between the original neighbours
+                next_index = min(num_keys - 1, index)
+                mt = om.MTime(t, unit)
+                value = curve_fn.evaluate(mt)
+                tangent_index = None
+                new_times.append(mt)
+                new_values.append(value)
+            
+            if is_curve_tangent:
+                add_tangent_points_to_key_group(key_group, curve_fn, prev_index, next_index, index=tangent_index)
+            
+            entries.append((t, value, key_values[prev_index], key_values[next_index]))
+        
+        if len(new_times) > 0:
+            curve_fn.addKeys(new_times, new_values,
+                             keepExistingKeys=True,
+                             change=anim_cache)
+            added_keys[curve_fn] = list(new_times)
+        
+        # key indices are resolved after all keys are added
+        for t, value, prev_val, next_val in entries:
+            key_index = curve_fn.find(om.MTime(t, unit))
+            if key_index is None:
+                key_index = curve_fn.findClosest(om.MTime(t, unit))
+            
+            key_group.key_index.append(key_index)
+            key_group.value.append(value)
+            key_group.prev_value.append(prev_val)
+            key_group.next_value.append(next_val)
+        
+        curve_key_values[curve_fn] = key_group
+
+
+def get_stride_times(start, end, stride):
+    """
+    Gets every stride frame from start to end, both included.
+    
+    :param start: First frame
+    :type start: float
+    :param end: Last frame
+    :type end: float
+    :param stride: Frames between each time
+    :type stride: float
+    :rtype: list of float
+    """
+    if stride <= 0:
+        raise ValueError('Stride must be greater than 0, got %s' % stride)
+    
+    if end < start:
+        return []
+    
+    # multiply instead of accumulating, so fractional strides do not drift
+    count = int((end - start) / stride + TIME_TOLERANCE) + 1
+    return [start + i * stride for i in range(count)]
+
+
+def prepare_indices(curve_fns, indices, mode, plugs=None):
+    """
+    Prepares the dictionary of animation curves for explicit curves and key indices, without reading any UI state.
+    
+    Indices are handled like selected keys, so consecutive indices blend between the keys before and after the group.
+    Indices outside the range of a curve are ignored for that curve.
+    
+    :param curve_fns: Animation curves
+    :type curve_fns: list of maya.api.OpenMayaAnim.MFnAnimCurve
+    :param indices: Key indices
+    :type indices: list of int
+    :param mode: Blending mode
+    :type mode: options.BlendingMode.Mode
+    :param plugs: Plugs the curves are connected to, used to find default values
+    :type plugs: list of maya.api.OpenMaya.MPlug or None
+    """
+    global curve_key_values
+    global added_keys
+    
+    is_default = bool(mode == options.BlendingMode.default)
+    is_curve_tangent = bool(mode == options.BlendingMode.curve)
+    
+    curve_key_values = {}
+    added_keys = {}
+    indices = sorted(set(indices))
+    
+    for plug_idx, curve_fn in enumerate(curve_fns):
+        num_keys = curve_fn.numKeys
+        curve_indices = [i for i in indices if 0 <= i < num_keys]
+        if not curve_indices:
+            continue
+        
+        default_val = None
+        if is_default:
+            if plugs:
+                default_val = utils.get_attribute_default_value(plugs[plug_idx])
+            else:
+                default_val = utils.get_anim_curve_default_value(curve_fn)
+        
+        key_group = KeyGroup(key_index=[],
+                             value=[],
+                             default_value=default_val,
+                             prev_value=[],
+                             next_value=[],
+                             tangent_points=[],
+                             has_two_segments=[])
+        
+        add_index_groups_to_key_group(curve_fn, curve_indices, key_group, is_curve_tangent)
+        curve_key_values[curve_fn] = key_group
+
+
+def add_index_groups_to_key_group(curve_fn, indices, key_group, is_curve_tangent):
+    """
+    Adds sorted key indices to the key group. Consecutive indices are grouped, so they all blend between the key
+    before and the key after the group.
+    """
+    index_group = []
+    groups = []
+    
+    # find groups of consecutive key indices
+    index_group.append(indices[0])
+    for i in range(1, len(indices)):
+        if indices[i] - indices[i - 1] < 2:
+            index_group.append(indices[i])
+        else:
+            groups.append(index_group)
+            index_group = [indices[i]]
+    
+    # append last iteration
+    groups.append(index_group)
+    
+    for grp in groups:
+        prev_index = max(0, grp[0] - 1)
+        next_index = min(grp[-1] + 1, curve_fn.numKeys - 1)
+        
+        for idx in grp:
+            add_to_key_group(curve_fn, idx, prev_index, next_index, key_group)
+        
+        if is_curve_tangent:
+            for idx in grp:
+                add_tangent_points_to_key_group(key_group, curve_fn, prev_index, next_index, index=idx)
+
+
+def split_visible_curve_key_values():
+    """
+    Splits the prepared curves into the ones that are visible and the rest. A curve is visible when it drives a
+    visible object in the active view, when no driven object can be found, or when it is selected while the graph
+    editor is visible.
+    
+    :return: Tuple of visible and hidden curve key values
+    :rtype: (dict, dict)
+    """
+    visible = {}
+    hidden = {}
+    
+    view = omui2.M3dView.active3dView()
+    
+    selected = set()
+    if utils.panel_cache.is_visible('graphEditor'):
+        selected = set(om.MObjectHandle(curve).hashCode() for curve in utils.get_selected_anim_curves())
+    
+    for curve_fn, key_group in curve_key_values.items():
+        if om.MObjectHandle(curve_fn.object()).hashCode() in selected:
+            visible[curve_fn] = key_group
+            continue
+        
+        # a curve that drives no dag node that can be found may still change what is shown, so it stays visible
+        paths = utils.get_affected_dag_paths([curve_fn])
+        if not paths:
+            visible[curve_fn] = key_group
+            continue
+        
+        paths = [path for path in paths if path.isVisible()]
+        if paths and utils.is_view_showing_any(view, paths):
+            visible[curve_fn] = key_group
+        else:
+            hidden[curve_fn] = key_group
+    
+    return visible, hidden
+
+
 def add_to_key_group(curve_fn, index, prev_index, next_index, key_group):
     """
     Adds a single curve function object to the collection of keys we wish to manipulate.
@@ -151,6 +151,80 @@ class Cache(object):
         return self.__unlocked_layers
 
 
+class CurveIndex(object):
+    """
+    Index of the animation curves on each animation layer.
+    
+    Layers are only indexed when first asked for, and the index is cleared when connections change or a scene is
+    opened. Without registered callbacks nothing is stored.
+    """
+    def __init__(self):
+        self.__layer_curves = {}
+        self.__callback_ids = []
+    
+    def reset(self, *args):
+        """
+        Clears the index. Also used as callback, hence *args.
+        """
+        self.__layer_curves = {}
+    
+    def add_callbacks(self):
+        """
+        Registers the callbacks that clear the index.
+        """
+        self.remove_callbacks()
+        
+        self.__callback_ids = utils.add_graph_callbacks(self.reset, self.reset)
+    
+    def remove_callbacks(self):
+        """
+        Removes all callbacks registered by the index.
+        """
+        utils.remove_callback_ids(self.__callback_ids)
+        
+        self.__callback_ids = []
+        self.reset()
+    
+    def get_curves(self, layer):
+        """
+        Get the animation curves on the layer.
+        
+        :param layer: Animation layer
+        :type layer: maya.api.OpenMaya.MObject
+        :return: List of animation curves
+        :rtype: list of maya.api.OpenMaya.MObject
+        """
+        key = om.MObjectHandle(layer).hashCode()
+        
+        curves = self.__layer_curves.get(key)
+        if curves is None:
+            curves = get_layer_anim_curves(layer)
+            if self.__callback_ids:
+                self.__layer_curves[key] = curves
+        
+        return curves
+
+
+def get_layer_anim_curves(layer):
+    """
+    Get the animation curves on the layer.
+    
+    :param layer: Animation layer
+    :type layer: maya.api.OpenMaya.MObject
+    :return: List of animation curves
+    :rtype: list of maya.api.OpenMaya.MObject
+    """
+    names = cmds.animLayer(om.MFnDependencyNode(layer).name(), q=True, animCurves=True)
+    if not names:
+        return []
+    
+    sel = om.MSelectionList()
+    for name in names:
+        sel.add(name)
+    
+    return [sel.getDependNode(i) for i in range(sel.length())]
+
+
 def has_anim_layers():
     """
     Checks whether the scene has any animation layers.
@@ -462,3 +536,4 @@ def get_best_layer(plug):
 
 
 cache = Cache()
+curve_index = CurveIndex()
@@ -0,0 +1,434 @@
+"""
+mods.batch
+
+Runs Tweener operations (key hammer and tweens) on many scene files, without the UI.
+
+The scene files are distributed over a pool of mayapy worker processes. Each worker opens one scene, runs the
+operations on explicit curves and times, optionally saves the scene and writes a JSON report with timings.
+
+Usage, from any Python interpreter:
+
+    python mods/batch.py --mayapy /path/to/mayapy --ops ops.json --report-dir reports --save shot_*.ma
+
+The operations file is a JSON list, where each operation is one of:
+
+    {"op": "keyhammer", "curves": null, "times": null, "time_range": [1, 100], "preserve_shape": false}
+    {"op": "tween", "curves": ["pCube1_translateX"], "times": null, "marked": true, "mode": "between", "blend": 0.0}
+
+curves is a list of anim curve names or null for all anim curves in the scene. times is a list of frames in the scene's
+time unit. For tweens, marked uses the keys with the special tick color as times. blend is the tweener interpolant
+in the range [-1;1].
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+if sys.version_info >= (3, 0):
+    import queue
+else:
+    import Queue as queue
+
+
+def run(scenes, operations, mayapy, workers=2, report_dir='.', save=False, output_dir=None, timeout=None):
+    """
+    Runs the operations on all scenes, using a pool of mayapy processes.
+    
+    :param scenes: Scene file paths
+    :type scenes: list of str
+    :param operations: Operations to run on each scene, see module docstring
+    :type operations: list of dict
+    :param mayapy: Path to the mayapy executable
+    :type mayapy: str
+    :param workers: Number of mayapy processes to run at the same time
+    :type workers: int
+    :param report_dir: Folder to write the per scene reports to
+    :type report_dir: str
+    :param save: Save the scenes after running the operations
+    :type save: bool
+    :param output_dir: Save the scenes to this folder instead of overwriting them
+    :type output_dir: str or None
+    :param timeout: Seconds before a worker is stopped, None to wait forever
+    :type timeout: float or None
+    :return: Reports of all scenes
+    :rtype: list of dict
+    """
+    # a scene listed twice would have two workers writing the same report and saved scene
+    names = set()
+    for scene in scenes:
+        name = get_scene_name(scene)
+        if name in names:
+            raise ValueError('Scene %s is listed more than once' % scene)
+        names.add(name)
+    
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    
+    ops_path = os.path.join(report_dir, 'operations.json')
+    with open(ops_path, 'w') as f:
+        json.dump(operations, f, indent=2)
+    
+    jobs = queue.Queue()
+    for scene in scenes:
+        jobs.put(scene)
+    
+    reports = []
+    lock = threading.Lock()
+    
+    def work():
+        while True:
+            try:
+                scene = jobs.get_nowait()
+            except queue.Empty:
+                return
+            
+            report = run_process(scene, ops_path, mayapy, report_dir, save, output_dir, timeout)
+            
+            with lock:
+                reports.append(report)
+                sys.stdout.write('# %s %s (%.1fs)\n' % ('Done' if report['success'] else 'Failed',
+                                                        scene, report['total_seconds']))
+    
+    threads = [threading.Thread(target=work) for _ in range(max(1, min(workers, len(scenes))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    with open(os.path.join(report_dir, 'summary.json'), 'w') as f:
+        json.dump(reports, f, indent=2)
+    
+    return reports
+
+
+def run_process(scene, ops_path, mayapy, report_dir, save=False, output_dir=None, timeout=None):
+    """
+    Runs the operations on a single scene in a new mayapy process and reads its report.
+    
+    :return: Report of the scene
+    :rtype: dict
+    """
+    report_path = get_report_path(scene, report_dir)
+    args = [mayapy, os.path.abspath(__file__), '--worker', '--ops', ops_path, '--report', report_path]
+    
+    if save:
+        args.append('--save')
+    if output_dir:
+        args.extend(['--output-dir', output_dir])
+    
+    args.append(scene)
+    
+    # a report left by an earlier run must not be mistaken for the result of this one
+    if os.path.isfile(report_path):
+        os.remove(report_path)
+    
+    start_time = time.time()
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    
+    # communicate(timeout=...) does not exist in Python 2, so the process is killed from a timer
+    timer = None
+    killed = threading.Event()
+    if timeout:
+        def kill():
+            killed.set()
+            process.kill()
+        
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    
+    output = process.communicate()[0]
+    
+    if timer:
+        timer.cancel()
+    
+    # the worker also writes its report when an operation fails, which has more detail than the output
+    if not killed.is_set() and os.path.isfile(report_path):
+        try:
+            with open(report_path) as f:
+                return json.load(f)
+        except ValueError:
+            pass  # the report was not written completely
+    
+    # the worker did not get to write its report
+    if isinstance(output, bytes):
+        output = output.decode('utf-8', 'replace')
+    
+    report = new_report(scene)
+    if killed.is_set():
+        report['error'] = 'mayapy was stopped after %s seconds\n%s' % (timeout, output[-4000:])
+    else:
+        report['error'] = 'mayapy exited with code %s\n%s' % (process.returncode, output[-4000:])
+    report['total_seconds'] = time.time() - start_time
+    write_report(report, report_path)
+    
+    return report
+
+
+def run_worker(scene, operations, report_path, save=False, output_dir=None):
+    """
+    Runs the operations on a scene inside mayapy and writes the report. Called in the worker process.
+    
+    :return: True on success
+    :rtype: bool
+    """
+    report = new_report(scene)
+    start_time = time.time()
+    initialized = False
+    
+    try:
+        import maya.standalone
+        maya.standalone.initialize(name='python')
+        initialized = True
+        
+        import maya.cmds as cmds
+        
+        t = time.time()
+        cmds.file(scene, open=True, force=True, prompt=False)
+        report['open_seconds'] = time.time() - t
+        
+        for operation in operations:
+            report['operations'].append(run_operation(operation))
+        
+        if save or output_dir:
+            t = time.time()
+            save_scene(scene, output_dir)
+            report['save_seconds'] = time.time() - t
+        
+        report['success'] = True
+    except Exception as e:
+        import traceback
+        report['error'] = '%s\n%s' % (e, traceback.format_exc())
+    
+    try:
+        report['total_seconds'] = time.time() - start_time
+        write_report(report, report_path)
+    finally:
+        # without this mayapy may crash or hang on exit, which would change the exit code
+        if initialized:
+            maya.standalone.uninitialize()
+    
+    return report['success']
+
+
+def run_operation(operation):
+    """
+    Runs a single operation on the open scene.
+    
+    :param operation: Operation, see module docstring
+    :type operation: dict
+    :return: Report of the operation
+    :rtype: dict
+    """
+    if sys.version_info >= (3, 0):
+        import mods.animdata as animdata
+        import mods.keyhammer as keyhammer
+        import mods.options as options
+        import mods.tween as tween
+    else:
+        import animdata as animdata
+        import keyhammer as keyhammer
+        import options as options
+        import tween as tween
+    
+    start_time = time.time()
+    op = operation.get('op')
+    curve_fns = get_curves(operation.get('curves'))
+    result = {'op': op, 'curves': len(curve_fns)}
+    
+    if op == 'keyhammer':
+        time_range = operation.get('time_range')
+        counts = keyhammer.hammer(curve_fns,
+                                  times=operation.get('times'),
+                                  time_range=tuple(time_range) if time_range else None,
+                                  preserve_shape=operation.get('preserve_shape', False))
+        result['keys_added'] = sum(counts)
+    
+    elif op == 'tween':
+        mode = options.BlendingMode.get_mode_from_name(str(operation.get('mode', 'between')))
+        
+        if operation.get('marked'):
+            times = get_marked_times(curve_fns)
+        else:
+            times = operation.get('times') or []
+        
+        # no undo in batch
+        animdata.anim_cache = None
+        animdata.prepare_times(curve_fns, times, mode)
+        tween.interpolate(blend=float(operation.get('blend', 0.0)), mode=mode)
+        
+        result['times'] = len(times)
+        result['keys_changed'] = sum(len(key_group.key_index) for key_group in animdata.curve_key_values.values())
+    
+    else:
+        raise ValueError('Unknown operation %s' % op)
+    
+    result['seconds'] = time.time() - start_time
+    
+    return result
+
+
+def get_curves(names=None):
+    """
+    Gets anim curves by name (animated nodes are expanded), or all anim curves Tweener can modify in the scene.
+    
+    :param names: Anim curve names or None for all
+    :type names: list of str or None
+    :rtype: list of maya.api.OpenMayaAnim.MFnAnimCurve
+    """
+    import maya.api.OpenMaya as om
+    import maya.api.OpenMayaAnim as oma
+    
+    if sys.version_info >= (3, 0):
+        import mods.utils as utils
+    else:
+        import utils as utils
+    
+    if names is not None:
+        return [oma.MFnAnimCurve(obj) for obj in utils.get_anim_curves_from_names(names)]
+    
+    objects = []
+    it = om.MItDependencyNodes(om.MFn.kAnimCurve)
+    while not it.isDone():
+        objects.append(it.thisNode())
+        it.next()
+    
+    return [oma.MFnAnimCurve(obj) for obj in objects if obj.apiType() in utils.ANIM_CURVE_TYPES]
+
+
+def get_marked_times(curve_fns):
+    """
+    Gets the times of all keys that use the special tick color.
+    
+    :param curve_fns: Animation curves
+    :type curve_fns: list of maya.api.OpenMayaAnim.MFnAnimCurve
+    :return: Sorted times in the current time unit
+    :rtype: list of float
+    """
+    import maya.api.OpenMaya as om
+    
+    unit = om.MTime.uiUnit()
+    times = set()
+    
+    for curve_fn in curve_fns:
+        if not curve_fn.hasAttribute('kyts'):
+            continue
+        
+        plug = curve_fn.findPlug('kyts', True)
+        for i in plug.getExistingArrayAttributeIndices():
+            if i < curve_fn.numKeys and plug.elementByLogicalIndex(i).asBool():
+                times.add(curve_fn.input(i).asUnits(unit))
+    
+    return sorted(times)
+
+
+def save_scene(scene, output_dir=None):
+    """
+    Saves the open scene, either over the original file or in the output folder, named like its report.
+    """
+    import maya.cmds as cmds
+    
+    path = scene
+    if output_dir:
+        if not os.path.isdir(output_dir):
+            try:
+                os.makedirs(output_dir)
+            except OSError:
+                pass  # another worker created it
+        
+        path = os.path.join(output_dir, get_scene_name(scene) + os.path.splitext(scene)[1])
+    
+    file_type = 'mayaBinary' if path.lower().endswith('.mb') else 'mayaAscii'
+    cmds.file(rename=path)
+    cmds.file(save=True, force=True, type=file_type)
+
+
+def get_report_path(scene, report_dir):
+    """
+    Gets the path of the report for a scene.
+    
+    :rtype: str
+    """
+    return os.path.join(report_dir, get_scene_name(scene) + '.json')
+
+
+def get_scene_name(scene):
+    """
+    Gets a file name for a scene's report and saved copy, without extension. Scenes with the same name in different
+    folders get different names, and no name can be the same as operations.json or summary.json.
+    
+    :return: Scene name followed by a short hash of its full path
+    :rtype: str
+    """
+    path = os.path.normcase(os.path.abspath(scene))
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    
+    name = os.path.splitext(os.path.basename(scene))[0]
+    return '%s_%s' % (name, hashlib.sha1(path).hexdigest()[:8])
+
+
+def new_report(scene):
+    """
+    Creates an empty report for a scene.
+    
+    :rtype: dict
+    """
+    return {'scene': scene,
+            'success': False,
+            'error': None,
+            'open_seconds': 0.0,
+            'save_seconds': 0.0,
+            'total_seconds': 0.0,
+            'operations': []}
+
+
+def write_report(report, path):
+    """
+    Writes a report as JSON.
+    """
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Tweener operations on scene files using mayapy.')
+    parser.add_argument('scenes', nargs='+', help='Scene files')
+    parser.add_argument('--ops', required=True, help='JSON file with the list of operations')
+    parser.add_argument('--mayapy', default='mayapy', help='Path to mayapy')
+    parser.add_argument('--workers', type=int, default=2, help='Number of mayapy processes')
+    parser.add_argument('--report-dir', default='.', help='Folder for the JSON reports')
+    parser.add_argument('--save', action='store_true', help='Save the scenes')
+    parser.add_argument('--output-dir', default=None, help='Save the scenes to this folder')
+    parser.add_argument('--timeout', type=float, default=None, help='Seconds before a worker is stopped')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--report', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    
+    with open(args.ops) as f:
+        operations = json.load(f)
+    
+    if args.worker:
+        # make the mods package importable in the worker
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        success = run_worker(args.scenes[0], operations, args.report, save=args.save, output_dir=args.output_dir)
+        return 0 if success else 1
+    
+    try:
+        reports = run(args.scenes, operations, args.mayapy,
+                      workers=args.workers,
+                      report_dir=args.report_dir,
+                      save=args.save,
+                      output_dir=args.output_dir,
+                      timeout=args.timeout)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    return 0 if all(report['success'] for report in reports) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,10 @@
 """
 keyhammer
 """
+import bisect
+import heapq
 import sys
+import time
 
 import maya.api.OpenMaya as om
 import maya.api.OpenMayaAnim as oma
@@ -10,105 +13,973 @@ import maya.mel as mel
 
 if sys.version_info >= (3, 0):
     import mods.animdata as animdata
+    import mods.animlayers as animlayers
     import mods.utils as utils
 else:
     import animdata as animdata
+    import animlayers as animlayers
     import utils as utils
-    
 
-def do():
+# which animation layers to key, 'best' is the same layer Tweener itself uses for each attribute
+LAYER_SCOPE_BEST = 'best'
+LAYER_SCOPE_SELECTED = 'selected'
+LAYER_SCOPE_ALL = 'all'
+LAYER_SCOPES = [LAYER_SCOPE_BEST, LAYER_SCOPE_SELECTED, LAYER_SCOPE_ALL]
+
+# times closer than this are considered the same key
+TIME_TOLERANCE = 1e-6
+
+# tangent types that are kept on inserted keys, everything else uses the default tangent (see get_insert_tangents)
+STEP_TANGENT_TYPES = [oma.MFnAnimCurve.kTangentStep, oma.MFnAnimCurve.kTangentStepNext]
+LINEAR_TANGENT_TYPES = [oma.MFnAnimCurve.kTangentLinear]
+DEFAULT_TANGENT_TYPE = oma.MFnAnimCurve.kTangentGlobal
+
+# largest value difference allowed when checking that a subdivided curve kept its shape
+SHAPE_TOLERANCE = 1e-4
+
+# seconds of work per idle event when running in the background
+TICK_BUDGET = 0.03
+
+# seconds between progress bar updates
+PROGRESS_INTERVAL = 0.1
+
+# rough size of a key (time, value, tangents and flags) and overhead per curve, used for estimates
+KEY_MEMORY_ESTIMATE = 96
+SECONDS_PER_CURVE = 2e-5
+
+# seconds per added key for the normal and shape preserving mode, updated from completed jobs
+seconds_per_key = {False: 2e-5, True: 8e-5}
+
+current_job = None
+
+
+def do(preserve_shape=False, background=False, layer_scope=LAYER_SCOPE_BEST, use_channelbox=True):
     """
     Creates a key on all attributes at any time-value, where a key exists in the curves list
-    :return True on complete, False if cancelled
+    :param preserve_shape: Split the curve segments, so the curves keep their exact shape
+    :type preserve_shape: bool
+    :param background: Add the keys in time slices while Maya is idle, instead of blocking until done
+    :type background: bool
+    :param layer_scope: Animation layers to key, one of LAYER_SCOPES
+    :type layer_scope: str
+    :param use_channelbox: Only key attributes selected in the channel box, if any
+    :type use_channelbox: bool
+    :return True on complete (or started in the background), False if cancelled
     :rtype bool
     """
+    global current_job
+    
+    # only one job at a time, so finish the running one first
+    finish_job()
+    current_job = None
+    
+    curve_fns, key_times, key_offsets, times, unit, time_range = collect(layer_scope=layer_scope,
+                                                                         use_channelbox=use_channelbox)
+    
+    if len(curve_fns) == 0:
+        sys.stdout.write('# No anim curves to set keys on\n')
+        return True
+    
+    current_job = KeyHammerJob(curve_fns, key_times, key_offsets, times, unit,
+                               time_range=time_range,
+                               preserve_shape=preserve_shape,
+                               change=animdata.anim_cache)
+    
+    if background:
+        current_job.start()
+        return True
+    
+    return current_job.run()
+
+
+def finish_job():
+    """
+    Processes the rest of a job running in the background, so it does not add keys after other commands have changed
+    the curves.
+    """
+    if current_job is not None and not current_job.is_done:
+        current_job.run()
+
+
+def estimate(preserve_shape=False, layer_scope=LAYER_SCOPE_BEST, use_channelbox=True):
+    """
+    Computes the keys key hammer would add, without modifying any curves.
+    
+    :param preserve_shape: Estimate the run time of the shape preserving mode
+    :type preserve_shape: bool
+    :param layer_scope: Animation layers to key, one of LAYER_SCOPES
+    :type layer_scope: str
+    :param use_channelbox: Only key attributes selected in the channel box, if any
+    :type use_channelbox: bool
+    :return: Dictionary with the keys per curve name ('curves'), total keys ('total'), estimated memory growth in bytes
+             ('memory') and estimated run time in seconds ('time')
+    :rtype: dict
+    """
+    curve_fns, key_times, key_offsets, times, unit, time_range = collect(layer_scope=layer_scope,
+                                                                         use_channelbox=use_channelbox)
+    
+    counts = {}
+    total = 0
+    for curve_fn, curve_key_times in zip(curve_fns, key_times):
+        count = len(get_missing_times(curve_key_times, times))
+        counts[curve_fn.absoluteName()] = count
+        total += count
+    
+    return {'curves': counts,
+            'total': total,
+            'memory': total * KEY_MEMORY_ESTIMATE,
+            'time': total * seconds_per_key[bool(preserve_shape)] + len(curve_fns) * SECONDS_PER_CURVE}
+
+
+def collect(layer_scope=LAYER_SCOPE_BEST, use_channelbox=True):
+    """
+    Gets the curves to key and the times they should have keys at, from the selection and the time slider.
+    
+    :param layer_scope: Animation layers to key, one of LAYER_SCOPES
+    :type layer_scope: str
+    :param use_channelbox: Only key attributes selected in the channel box, if any
+    :type use_channelbox: bool
+    :return: Curves, sorted key times of each curve, index of the first key in each list of key times, sorted times
+             to key, the time unit of all times and the time slider range or None
+    :rtype: (list of maya.api.OpenMayaAnim.MFnAnimCurve, list of (list of float), list of int, list of float, int,
+             (float, float) or None)
+    """
     # get selection
     if utils.is_graph_editor_or_dope_sheet():
         curves = utils.get_selected_anim_curves()
     else:
-        nodes = utils.get_selected_objects()
-        curves, plugs = utils.get_anim_curves_from_objects(nodes)
+        curves = get_scoped_anim_curves(utils.get_selected_objects(), layer_scope, use_channelbox)
     
     # get curve functions
     curve_fns = []
-    for curve_node in curves:
-        curve_fns.append(oma.MFnAnimCurve(curve_node.object()))
+    for curve_obj in curves:
+        curve_fns.append(oma.MFnAnimCurve(curve_obj))
+    
+    unit = om.MTime.uiUnit()
     
     if len(curve_fns) == 0:
-        sys.stdout.write('# No anim curves to set keys on\n')
-        return True
+        return curve_fns, [], [], [], unit, None
     
     # get time range
     time_range = utils.get_time_slider_range()
-    is_range = time_range[0] - time_range[1] != 0
-    
-    # get time for keyframes
-    times = set()
-    selected_keys = cmds.keyframe(q=True, selected=True, timeChange=True) if is_range is False else None
-    
-    if is_range:
-        unit = om.MTime.uiUnit()
-        min_time = om.MTime(time_range[0], unit)
-        max_time = om.MTime(time_range[1], unit)
-        for curve_fn in curve_fns:
-            start_index = max(0, curve_fn.findClosest(min_time))  # -1 just to be safe, is checked later
-            end_index = min(curve_fn.numKeys, curve_fn.findClosest(max_time))  # +1 just to be safe
-            for i in range(start_index, end_index):
-                times.add(curve_fn.input(i).value)
-    elif selected_keys is not None:
-        times = set(selected_keys)
+    
+    if time_range[0] - time_range[1] != 0:
+        key_times, key_offsets, times = get_times(curve_fns, unit, time_range=time_range)
     else:
-        for curve_fn in curve_fns:
-            for i in range(curve_fn.numKeys):
-                times.add(curve_fn.input(i).value)
-    
-    # get main progress bar start progress
-    gMainProgressBar = mel.eval('$tmp = $gMainProgressBar')
-    cmds.progressBar(gMainProgressBar,
-                     e=True,
-                     beginProgress=True,
-                     isInterruptable=True,
-                     status='Adding keyframes...',
-                     maxValue=len(curve_fns))
-    
-    # convert to MTime()
-    m_times = []
+        # get time for keyframes
+        time_range = None
+        selected_keys = cmds.keyframe(q=True, selected=True, timeChange=True)
+        key_times, key_offsets, times = get_times(curve_fns, unit, times=selected_keys)
+    
+    return curve_fns, key_times, key_offsets, times, unit, time_range
+
+
+def get_times(curve_fns, unit, times=None, time_range=None):
+    """
+    Reads the key times of the curves and gets the times all curves should have keys at.
+    
+    :param curve_fns: Animation curves
+    :type curve_fns: list of maya.api.OpenMayaAnim.MFnAnimCurve
+    :param unit: Time unit of all times
+    :type unit: int
+    :param times: Explicit times to key, otherwise the union of all key times is used
+    :type times: list of float or None
+    :param time_range: Only use keys inside this range, start and end inclusive
+    :type time_range: (float, float) or None
+    :return: Sorted key times of each curve, index of the first key in each list of key times and sorted times to key
+    :rtype: (list of (list of float), list of int, list of float)
+    """
+    key_times = []
+    key_offsets = []
+    
+    for curve_fn in curve_fns:
+        if time_range is None:
+            start, end = 0, curve_fn.numKeys
+        else:
+            # only read the keys inside the range, which are found with a binary search
+            start, end = find_key_range(curve_fn, time_range[0], time_range[1], unit)
+        
+        key_times.append(get_key_times(curve_fn, unit, start, end))
+        key_offsets.append(start)
+    
+    if times is not None:
+        times = sorted(set(times))
+        if time_range is not None:
+            times = [t for t in times if time_range[0] <= t <= time_range[1]]
+    else:
+        times = merge_times(key_times)
+    
+    return key_times, key_offsets, times
+
+
+def hammer(curve_fns, times=None, time_range=None, preserve_shape=False, change=None):
+    """
+    Adds the missing keys to explicit curves, without reading the selection or any UI state.
+    
+    :param curve_fns: Animation curves
+    :type curve_fns: list of maya.api.OpenMayaAnim.MFnAnimCurve
+    :param times: Times to key in the current time unit, otherwise the union of all key times is used
+    :type times: list of float or None
+    :param time_range: Only key inside this range, start and end inclusive
+    :type time_range: (float, float) or None
+    :param preserve_shape: Split the curve segments, so the curves keep their exact shape
+    :type preserve_shape: bool
+    :param change: Change cache to record the changes in
+    :type change: maya.api.OpenMayaAnim.MAnimCurveChange or None
+    :return: Number of keys added to each curve
+    :rtype: list of int
+    """
     unit = om.MTime.uiUnit()
-    if is_range:
-        for t in times:
-            if time_range[0] <= t <= time_range[1]:
-                m_times.append(om.MTime(t, unit))
+    key_times, key_offsets, times = get_times(curve_fns, unit, times=times, time_range=time_range)
+    
+    counts = []
+    for curve_fn, curve_key_times, key_offset in zip(curve_fns, key_times, key_offsets):
+        missing_times = get_missing_times(curve_key_times, times)
+        if preserve_shape:
+            counts.append(add_keys_subdivided(curve_fn, curve_key_times, missing_times, unit,
+                                              change=change, key_offset=key_offset))
+        else:
+            counts.append(add_keys(curve_fn, curve_key_times, missing_times, unit,
+                                   change=change, key_offset=key_offset))
+    
+    return counts
+
+
+def get_scoped_anim_curves(nodes, layer_scope=LAYER_SCOPE_BEST, use_channelbox=True):
+    """
+    Gets the animation curves of the nodes within the layer scope.
+    
+    For the best layer, this is the same as utils.get_anim_curves_from_objects, as the layer is resolved per attribute
+    the way Tweener does. For the selected or all layers, layered curves come from the curve index of those layers.
+    Curves that are not on a layer belong to BaseAnimation, so they are only included when it is in scope, and are
+    found from the connected plugs of the nodes.
+    
+    :param nodes: List of node objects
+    :type nodes: list of maya.api.OpenMaya.MObject
+    :param layer_scope: Animation layers to key, one of LAYER_SCOPES
+    :type layer_scope: str
+    :param use_channelbox: Only key attributes selected in the channel box, if any
+    :type use_channelbox: bool
+    :return: Animation curves
+    :rtype: list of maya.api.OpenMaya.MObject
+    """
+    if layer_scope not in LAYER_SCOPES:
+        raise ValueError('Unknown layer scope %s, expected one of %s' % (layer_scope, ', '.join(LAYER_SCOPES)))
+    
+    if layer_scope == LAYER_SCOPE_BEST:
+        curves, plugs = utils.get_anim_curves_from_objects(nodes, use_channelbox=use_channelbox)
+        return curves
+    
+    if not animlayers.has_anim_layers():
+        curves, plugs = utils.get_unlayered_anim_curves(nodes, use_channelbox=use_channelbox)
+        return curves
+    
+    # the layer selection and lock states are not tracked by callbacks
+    animlayers.cache.reset()
+    
+    if layer_scope == LAYER_SCOPE_SELECTED:
+        layers = animlayers.cache.selected_layers or []
     else:
-        for t in times:
-            m_times.append(om.MTime(t, unit))
+        layers = animlayers.cache.unlocked_layers or []
     
-    # add keys
-    key_count = 0
-    cancelled = False
-    for curve_fn in curve_fns:
-        ts = []
-        vs = []
-        for mt in m_times:
-            if curve_fn.find(mt) is None:
-                ts.append(mt)
-                vs.append(curve_fn.evaluate(mt))
+    curves = []
+    if animlayers.cache.root.layer in layers:
+        curves, plugs = utils.get_unlayered_anim_curves(nodes, use_channelbox=use_channelbox)
+    
+    layered_curves, layered_plugs = utils.get_layered_anim_curves(nodes, layers, use_channelbox=use_channelbox)
+    
+    return curves + layered_curves
+
+
+class KeyHammerJob(object):
+    """
+    Adds the missing keys to a list of curves in chunks, so the work can be spread over several idle events.
+    
+    All changes are recorded in the MAnimCurveChange given on creation, so undoing the command that created the job
+    also undoes the keys added after the command returned. Cancelling a background job from the progress bar rolls
+    those changes back right away, as the command has already returned. In the background the key times are read
+    again before each curve is keyed, as the keys may have been edited since the job was created.
+    """
+    
+    def __init__(self, curve_fns, key_times, key_offsets, times, unit, time_range=None, preserve_shape=False,
+                 change=None):
+        """
+        :param curve_fns: Animation curves
+        :type curve_fns: list of maya.api.OpenMayaAnim.MFnAnimCurve
+        :param key_times: Sorted key times of each curve
+        :type key_times: list of (list of float)
+        :param key_offsets: Index of the first key in each list of key times
+        :type key_offsets: list of int
+        :param times: Sorted times that should have a key on all curves
+        :type times: list of float
+        :param unit: Time unit of the times
+        :type unit: int
+        :param time_range: Range the key times were read in, start and end inclusive, None for all keys
+        :type time_range: (float, float) or None
+        :param preserve_shape: Split the curve segments, so the curves keep their exact shape
+        :type preserve_shape: bool
+        :param change: Change cache to record the changes in
+        :type change: maya.api.OpenMayaAnim.MAnimCurveChange
+        """
+        self.curve_fns = curve_fns
+        self.handles = [om.MObjectHandle(curve_fn.object()) for curve_fn in curve_fns]
+        self.key_times = key_times
+        self.key_offsets = key_offsets
+        self.times = times
+        self.unit = unit
+        self.time_range = time_range
+        self.preserve_shape = preserve_shape
+        self.change = change
         
-        for t, v in zip(ts, vs):
-            curve_fn.addKey(t, v, change=animdata.anim_cache)
-            key_count += 1
+        self.index = 0
+        self.key_count = 0
+        self.elapsed = 0.0
+        self.is_done = False
+        self.cancelled = False
+        self.rolled_back = False
         
-        cmds.progressBar(gMainProgressBar, e=True, step=1)
+        self.in_background = False
+        self.callback_id = None
+        self.progress_bar = None
+        self.progress_time = 0.0
+    
+    def step(self, budget):
+        """
+        Processes curves until the time budget is used. At least one curve is processed.
         
-        if cmds.progressBar(gMainProgressBar, q=True, isCancelled=True):
-            cancelled = True
-            break
+        :param budget: Time budget in seconds
+        :type budget: float
+        :return: True when all curves are processed
+        :rtype: bool
+        """
+        start_time = time.time()
+        end_time = start_time + budget
+        
+        while self.index < len(self.curve_fns):
+            curve_fn = self.curve_fns[self.index]
+            curve_key_times = self.key_times[self.index]
+            key_offset = self.key_offsets[self.index]
+            
+            # the curve may have been deleted while running in the background
+            if self.handles[self.index].isValid():
+                if self.in_background:
+                    curve_key_times, key_offset = self.read_key_times(curve_fn)
+                
+                missing_times = get_missing_times(curve_key_times, self.times)
+                if self.preserve_shape:
+                    self.key_count += add_keys_subdivided(curve_fn, curve_key_times, missing_times, self.unit,
+                                                          change=self.change, key_offset=key_offset)
+                else:
+                    self.key_count += add_keys(curve_fn, curve_key_times, missing_times, self.unit,
+                                               change=self.change, key_offset=key_offset)
+            
+            self.index += 1
+            
+            if time.time() >= end_time:
+                break
+        
+        self.elapsed += time.time() - start_time
+        
+        return self.index >= len(self.curve_fns)
     
-    cmds.progressBar(gMainProgressBar, e=True, endProgress=True)
+    def read_key_times(self, curve_fn):
+        """
+        Reads the current key times of the curve in the job's time range.
+        
+        :param curve_fn: Animation curve
+        :type curve_fn: maya.api.OpenMayaAnim.MFnAnimCurve
+        :return: Sorted key times and the index of the first key
+        :rtype: (list of float, int)
+        """
+        if self.time_range is None:
+            start, end = 0, curve_fn.numKeys
+        else:
+            start, end = find_key_range(curve_fn, self.time_range[0], self.time_range[1], self.unit)
+        
+        return get_key_times(curve_fn, self.unit, start, end), start
     
-    if cancelled:
-        sys.stdout.write('# Keyhammer cancelled...\n')
-        return False
+    def run(self):
+        """
+        Processes all remaining curves before returning, while still updating and checking the progress bar.
+        
+        :return: True on complete, False if cancelled
+        :rtype: bool
+        """
+        self.stop_callback()
+        
+        if self.progress_bar is None:
+            self.begin_progress()
+        
+        while not self.step(PROGRESS_INTERVAL):
+            self.update_progress(force=True)
+            
+            if self.is_cancelled():
+                self.cancelled = True
+                break
+        
+        self.end()
+        
+        return not self.cancelled
+    
+    def start(self):
+        """
+        Starts processing the curves in the background, one time slice per idle event.
+        """
+        self.in_background = True
+        self.begin_progress()
+        self.callback_id = om.MEventMessage.addEventCallback('idle', self.tick)
+    
+    def tick(self, *args):
+        """
+        Idle event callback, which processes a single time slice.
+        """
+        try:
+            done = self.step(TICK_BUDGET)
+        except Exception as e:
+            sys.stderr.write('# Keyhammer stopped: %s\n' % e)
+            self.cancelled = True
+            self.end()
+            return
+        
+        if done:
+            self.end()
+            return
+        
+        self.update_progress()
+        
+        if self.is_cancelled():
+            self.cancelled = True
+            self.rollback()
+            self.end()
+    
+    def cancel(self):
+        """
+        Stops the job without processing the remaining curves, e.g. when the command is undone.
+        """
+        self.cancelled = True
+        self.end(report=False)
+    
+    def rollback(self):
+        """
+        Removes the keys added so far, when cancelled from the progress bar after the command returned.
+        """
+        if self.change is not None:
+            self.change.undoIt()
+            self.rolled_back = True
+    
+    def stop_callback(self):
+        """
+        Removes the idle callback, if running in the background.
+        """
+        if self.callback_id is not None:
+            try:
+                om.MMessage.removeCallback(self.callback_id)
+            except Exception:
+                pass
+            
+            self.callback_id = None
+    
+    def begin_progress(self):
+        """
+        Starts the main progress bar.
+        """
+        self.progress_bar = mel.eval('$tmp = $gMainProgressBar')
+        self.progress_time = time.time()
+        
+        cmds.progressBar(self.progress_bar,
+                         e=True,
+                         beginProgress=True,
+                         isInterruptable=True,
+                         status='Adding keyframes...',
+                         maxValue=max(1, len(self.curve_fns)))
+    
+    def update_progress(self, force=False):
+        """
+        Updates the progress bar, at most once per PROGRESS_INTERVAL unless forced.
+        """
+        now = time.time()
+        if not force and now - self.progress_time < PROGRESS_INTERVAL:
+            return
+        
+        self.progress_time = now
+        cmds.progressBar(self.progress_bar, e=True, progress=self.index)
+    
+    def is_cancelled(self):
+        """
+        Get whether the user pressed Esc to cancel the progress bar.
+        
+        :rtype: bool
+        """
+        return bool(cmds.progressBar(self.progress_bar, q=True, isCancelled=True))
+    
+    def end(self, report=True):
+        """
+        Stops the job, ends the progress bar and reports the result.
+        """
+        self.stop_callback()
+        self.is_done = True
+        
+        if self.progress_bar is not None:
+            cmds.progressBar(self.progress_bar, e=True, endProgress=True)
+            self.progress_bar = None
+        
+        if not report:
+            return
+        
+        if self.cancelled:
+            if self.rolled_back:
+                sys.stdout.write('# Keyhammer cancelled, removed the %d added key%s\n' %
+                                 (self.key_count, '' if self.key_count == 1 else 's'))
+            elif self.in_background and self.key_count:
+                # the command has already returned, so the added keys are left for the user to undo
+                sys.stdout.write('# Keyhammer cancelled, undo to remove the %d added key%s\n' %
+                                 (self.key_count, '' if self.key_count == 1 else 's'))
+            else:
+                sys.stdout.write('# Keyhammer cancelled...\n')
+        else:
+            sys.stdout.write('# Added %d key%s\n' % (self.key_count, '' if self.key_count == 1 else 's'))
+            self.update_estimate()
+    
+    def update_estimate(self):
+        """
+        Blends the measured time per key into the estimate used by estimate().
+        """
+        if self.key_count < 100:
+            return  # too few keys to say anything about the cost
+        
+        measured = max(0.0, self.elapsed - len(self.curve_fns) * SECONDS_PER_CURVE) / self.key_count
+        mode = bool(self.preserve_shape)
+        seconds_per_key[mode] = seconds_per_key[mode] * 0.5 + measured * 0.5
+
+
+def get_key_times(curve_fn, unit, start=0, end=None):
+    """
+    Reads the time of the keys on the curve from start up to, but not including, end.
+    
+    :param curve_fn: Animation curve
+    :type curve_fn: maya.api.OpenMayaAnim.MFnAnimCurve
+    :param unit: Time unit of the returned values
+    :type unit: int
+    :param start: Index of the first key
+    :type start: int
+    :param end: Index after the last key, None for all keys
+    :type end: int or None
+    :return: Sorted key times
+    :rtype: list of float
+    """
+    if end is None:
+        end = curve_fn.numKeys
+    
+    return [curve_fn.input(i).asUnits(unit) for i in range(start, end)]
+
+
+def find_key_range(curve_fn, min_time, max_time, unit):
+    """
+    Finds the keys inside the time range with a binary search on the curve, so only log(n) keys are read.
+    
+    :param curve_fn: Animation curve
+    :type curve_fn: maya.api.OpenMayaAnim.MFnAnimCurve
+    :param min_time: Start of the range, inclusive
+    :type min_time: float
+    :param max_time: End of the range, inclusive
+    :type max_time: float
+    :param unit: Time unit of the range
+    :type unit: int
+    :return: Index of the first key inside the range and the index after the last key inside the range
+    :rtype: (int, int)
+    """
+    # first key at or after the start
+    lo = 0
+    hi = curve_fn.numKeys
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if curve_fn.input(mid).asUnits(unit) < min_time - TIME_TOLERANCE:
+            lo = mid + 1
+        else:
+            hi = mid
+    
+    start = lo
+    
+    # first key after the end
+    hi = curve_fn.numKeys
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if curve_fn.input(mid).asUnits(unit) <= max_time + TIME_TOLERANCE:
+            lo = mid + 1
+        else:
+            hi = mid
+    
+    return start, lo
+
+
+def merge_times(key_times):
+    """
+    Merges sorted lists of key times into one sorted list without duplicates, using a k-way merge.
+    
+    :param key_times: Sorted key times of each curve
+    :type key_times: list of (list of float)
+    :return: Sorted times
+    :rtype: list of float
+    """
+    times = []
+    
+    for t in heapq.merge(*key_times):
+        if times and t - times[-1] <= TIME_TOLERANCE:
+            continue
+        
+        times.append(t)
+    
+    return times
+
+
+def get_missing_times(key_times, times):
+    """
+    Finds the times that do not have a key, by merging two sorted lists.
+    
+    :param key_times: Sorted key times of a curve
+    :type key_times: list of float
+    :param times: Sorted times that should have a key
+    :type times: list of float
+    :return: Sorted times without a key on the curve
+    :rtype: list of float
+    """
+    missing = []
+    i = 0
+    num_keys = len(key_times)
+    
+    for t in times:
+        while i < num_keys and key_times[i] < t - TIME_TOLERANCE:
+            i += 1
+        
+        if i < num_keys and abs(key_times[i] - t) <= TIME_TOLERANCE:
+            continue
+        
+        missing.append(t)
+    
+    return missing
+
+
+def add_keys(curve_fn, key_times, missing_times, unit, change=None, key_offset=0):
+    """
+    Adds keys at the missing times, with values evaluated before the curve is changed.
+    
+    Keys are inserted with one addKeys call per tangent type, which is usually a single call per curve. Stepped and
+    linear segments keep their shape, other segments may change, see get_insert_tangents.
+    
+    :param curve_fn: Animation curve
+    :type curve_fn: maya.api.OpenMayaAnim.MFnAnimCurve
+    :param key_times: Sorted key times of the curve, before adding keys
+    :type key_times: list of float
+    :param missing_times: Sorted times to add keys at
+    :type missing_times: list of float
+    :param unit: Time unit of the times
+    :type unit: int
+    :param change: Change cache to record the changes in
+    :type change: maya.api.OpenMayaAnim.MAnimCurveChange
+    :param key_offset: Index of the first key in key_times, when only some keys were read
+    :type key_offset: int
+    :return: Number of keys added
+    :rtype: int
+    """
+    if not missing_times:
+        return 0
+    
+    # evaluate everything first, as inserting keys changes the curve
+    m_times = [om.MTime(t, unit) for t in missing_times]
+    values = [curve_fn.evaluate(mt) for mt in m_times]
+    
+    # group keys by the tangent types of the segment they are inserted into
+    groups = {}
+    segment_tangents = {}
+    for t, mt, v in zip(missing_times, m_times, values):
+        index = key_offset + bisect.bisect_left(key_times, t) - 1
+        
+        tangents = segment_tangents.get(index)
+        if tangents is None:
+            tangents = get_insert_tangents(curve_fn, index)
+            segment_tangents[index] = tangents
+        
+        group = groups.get(tangents)
+        if group is None:
+            group = (om.MTimeArray(), om.MDoubleArray())
+            groups[tangents] = group
+        
+        group[0].append(mt)
+        group[1].append(v)
+    
+    for (in_tangent, out_tangent), (group_times, group_values) in groups.items():
+        curve_fn.addKeys(group_times, group_values,
+                         tangentInType=in_tangent,
+                         tangentOutType=out_tangent,
+                         keepExistingKeys=True,
+                         change=change)
+    
+    return len(missing_times)
+
+
+def get_insert_tangents(curve_fn, index):
+    """
+    Get the in and out tangent types for a key inserted after the key at index.
+    
+    Stepped and linear segments keep their type, so their shape is kept. Other segments use the global tangent type,
+    the same as addKey, so the user's default tangent preference applies and Maya may change the shape of the segment.
+    Only add_keys_subdivided keeps the exact shape of those.
+    
+    :param curve_fn: Animation curve
+    :type curve_fn: maya.api.OpenMayaAnim.MFnAnimCurve
+    :param index: Index of the key before the inserted key, -1 if it is inserted before the first key
+    :type index: int
+    :return: In and out tangent type
+    :rtype: (int, int)
+    """
+    if curve_fn.numKeys == 0:
+        return DEFAULT_TANGENT_TYPE, DEFAULT_TANGENT_TYPE
+    
+    if index < 0:
+        tangent = curve_fn.inTangentType(0)
     else:
-        sys.stdout.write('# Added %d key%s\n' % (key_count, '' if key_count == 1 else 's'))
+        tangent = curve_fn.outTangentType(index)
+    
+    if tangent in STEP_TANGENT_TYPES:
+        return oma.MFnAnimCurve.kTangentLinear, tangent
+    
+    if tangent in LINEAR_TANGENT_TYPES:
+        return tangent, tangent
+    
+    return DEFAULT_TANGENT_TYPE, DEFAULT_TANGENT_TYPE
+
+
+def add_keys_subdivided(curve_fn, key_times, missing_times, unit, change=None, key_offset=0):
+    """
+    Adds keys at the missing times while keeping the exact shape of the curve.
+    
+    Each affected bezier segment is split at the new times using de Casteljau subdivision, which gives the tangents of
+    the new keys and the new tangent lengths of the adjacent keys. The keys around split segments are set to fixed
+    tangents, so Maya does not recompute them. Stepped segments and times outside the keyed range are added as in
+    add_keys, without touching their neighbours. Afterwards the
+    curve is evaluated between the new keys and a warning is printed if its shape changed.
+    
+    :param curve_fn: Animation curve
+    :type curve_fn: maya.api.OpenMayaAnim.MFnAnimCurve
+    :param key_times: Sorted key times of the curve, before adding keys
+    :type key_times: list of float
+    :param missing_times: Sorted times to add keys at
+    :type missing_times: list of float
+    :param unit: Time unit of the times
+    :type unit: int
+    :param change: Change cache to record the changes in
+    :type change: maya.api.OpenMayaAnim.MAnimCurveChange
+    :param key_offset: Index of the first key in key_times, when only some keys were read
+    :type key_offset: int
+    :return: Number of keys added
+    :rtype: int
+    """
+    if not missing_times:
+        return 0
+    
+    num_keys = curve_fn.numKeys
+    plain_times = []
+    segments = {}
+    adjacent_indices = set()
+    
+    # group the times by the segment they split, only the keys around split segments get fixed tangents
+    for t in missing_times:
+        index = key_offset + bisect.bisect_left(key_times, t) - 1
+        
+        if 0 <= index < num_keys - 1 and curve_fn.outTangentType(index) not in STEP_TANGENT_TYPES:
+            segments.setdefault(index, []).append(t)
+            adjacent_indices.update((index, index + 1))
+        else:
+            plain_times.append(t)
+    
+    # split the segments, before the curve is modified
+    new_keys = []
+    adjacent_tangents = []
+    samples = []
+    for index, times in segments.items():
+        points = utils.get_curve_tangents_bezier_points(curve_fn, index, index + 1)
+        seconds = [om.MTime(t, unit).asUnits(om.MTime.kSeconds) for t in times]
         
-    return True
+        # sample the original curve halfway between the keys the segment will have
+        bounds = [curve_fn.input(index).asUnits(unit)] + times + [curve_fn.input(index + 1).asUnits(unit)]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            mt = om.MTime((a + b) * 0.5, unit)
+            samples.append((mt, curve_fn.evaluate(mt)))
+        
+        keys, out_tangent, in_tangent = subdivide_bezier(points, seconds)
+        new_keys.extend(zip(times, keys))
+        adjacent_tangents.append((curve_fn.input(index), out_tangent, False))
+        adjacent_tangents.append((curve_fn.input(index + 1), in_tangent, True))
+    
+    # fix the tangents of the adjacent keys, so adding keys does not change them
+    for index in adjacent_indices:
+        if curve_fn.inTangentType(index) not in STEP_TANGENT_TYPES:
+            curve_fn.setInTangentType(index, oma.MFnAnimCurve.kTangentFixed, change=change)
+        if curve_fn.outTangentType(index) not in STEP_TANGENT_TYPES:
+            curve_fn.setOutTangentType(index, oma.MFnAnimCurve.kTangentFixed, change=change)
+    
+    add_keys(curve_fn, key_times, plain_times, unit, change=change, key_offset=key_offset)
+    
+    if not new_keys:
+        return len(missing_times)
+    
+    new_keys.sort(key=lambda k: k[0])
+    m_times = om.MTimeArray()
+    values = om.MDoubleArray()
+    for t, key in new_keys:
+        m_times.append(om.MTime(t, unit))
+        values.append(key[0])
+    
+    curve_fn.addKeys(m_times, values,
+                     tangentInType=oma.MFnAnimCurve.kTangentFixed,
+                     tangentOutType=oma.MFnAnimCurve.kTangentFixed,
+                     keepExistingKeys=True,
+                     change=change)
+    
+    # set the exact tangents
+    tangents = adjacent_tangents
+    for mt, (t, key) in zip(m_times, new_keys):
+        tangents.append((mt, key[1], True))
+        tangents.append((mt, key[2], False))
+    
+    is_weighted = curve_fn.isWeighted
+    for mt, tangent, is_in_tangent in tangents:
+        index = curve_fn.find(mt)
+        if index is None:
+            continue
+        
+        if is_weighted:
+            curve_fn.setWeightsLocked(index, False, change=change)
+        
+        curve_fn.setTangent(index, tangent[0], tangent[1], is_in_tangent,
+                            change=change, convertUnits=False)
+    
+    error = max(abs(curve_fn.evaluate(mt) - value) for mt, value in samples)
+    if error > SHAPE_TOLERANCE:
+        sys.stdout.write('# Keyhammer changed the shape of %s by up to %g\n' % (curve_fn.name(), error))
+    
+    return len(missing_times)
+
+
+def subdivide_bezier(points, times):
+    """
+    Splits a cubic bezier segment at the given times using de Casteljau subdivision.
+    
+    All parameters are solved on the original segment in one increasing pass, each starting from the previous one, and
+    the remainder is split at the parameter mapped to its own range.
+    
+    :param points: Four points of the segment, as returned by utils.get_curve_tangents_bezier_points
+    :type points: tuple of utils.Point
+    :param times: Sorted times in seconds, inside the segment
+    :type times: list of float
+    :return: List of [value, in tangent, out tangent] for each time, out tangent of the first key and in tangent of the
+             last key. Tangents are (x, y) in the form used by MFnAnimCurve.getTangentXY.
+    :rtype: (list of list, (float, float), (float, float))
+    """
+    keys = []
+    first_out_tangent = None
+    segment = points
+    prev_u = 0.0
+    
+    for t in times:
+        u = solve_bezier_x(segment, t, lo=prev_u)
+        left, right = split_bezier(points, (u - prev_u) / max(1.0 - prev_u, 1e-12))
+        prev_u = u
+        
+        if first_out_tangent is None:
+            first_out_tangent = tangent_xy(left[0], left[1])
+        else:
+            # splitting the remainder again also shortens the out handle of the previous new key
+            keys[-1][2] = tangent_xy(left[0], left[1])
+        
+        keys.append([left[3].y, tangent_xy(left[2], left[3]), tangent_xy(right[0], right[1])])
+        points = right
+    
+    return keys, first_out_tangent, tangent_xy(points[2], points[3])
+
+
+def split_bezier(points, u):
+    """
+    Splits a cubic bezier at parameter u.
+    
+    :param points: Four points of the bezier
+    :type points: tuple of utils.Point
+    :param u: Parameter in range [0;1]
+    :type u: float
+    :return: Points of the left and the right bezier
+    :rtype: (tuple of utils.Point, tuple of utils.Point)
+    """
+    p0, p1, p2, p3 = points
+    
+    q0 = lerp_point(p0, p1, u)
+    q1 = lerp_point(p1, p2, u)
+    q2 = lerp_point(p2, p3, u)
+    r0 = lerp_point(q0, q1, u)
+    r1 = lerp_point(q1, q2, u)
+    s = lerp_point(r0, r1, u)
+    
+    return (p0, q0, r0, s), (s, r1, q2, p3)
+
+
+def solve_bezier_x(points, x, lo=0.0, iterations=50):
+    """
+    Finds the bezier parameter for the given x (time), using Newton's method kept inside a bisection bracket. Maya keeps
+    x increasing along a segment, so this usually converges in a few iterations.
+    
+    :param points: Four points of the bezier
+    :type points: tuple of utils.Point
+    :param x: Time in seconds
+    :type x: float
+    :param lo: Lower bound of the parameter, e.g. the parameter of an earlier time
+    :type lo: float
+    :param iterations: Maximum number of iterations
+    :type iterations: int
+    :return: Parameter in range [lo;1]
+    :rtype: float
+    """
+    x0, x1, x2, x3 = points[0].x, points[1].x, points[2].x, points[3].x
+    hi = 1.0
+    
+    # start from the linear guess
+    u = utils.clamp((x - x0) / (x3 - x0), lo, hi) if x3 != x0 else lo
+    
+    for _ in range(iterations):
+        mu = 1.0 - u
+        error = mu * mu * mu * x0 + 3.0 * mu * mu * u * x1 + 3.0 * mu * u * u * x2 + u * u * u * x3 - x
+        
+        if abs(error) < 1e-10:
+            break
+        
+        if error < 0.0:
+            lo = u
+        else:
+            hi = u
+        
+        slope = 3.0 * (mu * mu * (x1 - x0) + 2.0 * mu * u * (x2 - x1) + u * u * (x3 - x2))
+        next_u = u - error / slope if slope > 1e-12 else -1.0
+        
+        # fall back to bisection when the newton step leaves the bracket
+        if not lo < next_u < hi:
+            next_u = (lo + hi) * 0.5
+        
+        u = next_u
+    
+    return u
+
+
+def lerp_point(a, b, u):
+    """
+    Linear interpolate between two points.
+    
+    :rtype: utils.Point
+    """
+    return utils.Point(a.x + (b.x - a.x) * u, a.y + (b.y - a.y) * u)
+
+
+def tangent_xy(a, b):
+    """
+    Get the tangent between a key and its control point, in the form used by MFnAnimCurve.getTangentXY.
+    
+    :rtype: (float, float)
+    """
+    return 3.0 * (b.x - a.x), 3.0 * (b.y - a.y)
@@ -2,9 +2,25 @@
 options module
 
 Takes care of saving and loading preferences in Maya.
+
+Preferences are kept in memory by the options store, which reads all optionVars once and writes changes back
+when Maya is idle, so gestures never query optionVars.
 """
 import maya.cmds as cmds
 
+# default value of every stored optionVar, strings are saved as string optionVars and everything else as int
+OPTION_DEFAULTS = {'tweener_interp_type_id': 0,
+                   'tweener_overshoot': False,
+                   'tweener_live_preview': True,
+                   'tweener_toolbar': True,
+                   'tweener_presets': True,
+                   'tweener_tick_draw_special': False,
+                   'tweener_keyhammer_preserve_shape': False,
+                   'tweener_keyhammer_layer_scope': 'best',
+                   'tweener_refresh_policy': 'affected',
+                   'tweener_preview_lod': False,
+                   'tweener_preview_shadow': False}
+
 
 class BlendingMode:
     """
@@ -36,6 +52,15 @@ class BlendingMode:
                 return m
         
         return BlendingMode.between
+    
+    @staticmethod
+    def get_mode_from_name(name):
+        for m in BlendingMode.modes:
+            if m.name.lower() == name.lower():
+                return m
+        
+        raise ValueError('Unknown blending mode %s, expected one of %s' %
+                         (name, ', '.join(m.name.lower() for m in BlendingMode.modes)))
 
 
 def save_interpolation_mode(idx=0):
@@ -44,7 +69,7 @@ def save_interpolation_mode(idx=0):
     :param idx: The blending mode idx
     :type idx: int
     """
-    cmds.optionVar(iv=('tweener_interp_type_id', idx))
+    store.set('tweener_interp_type_id', int(idx))
 
 
 def load_interpolation_mode():
@@ -53,10 +78,7 @@ def load_interpolation_mode():
     :return: The loaded blending mode.
     :rtype: BlendingMode.Mode
     """
-    if cmds.optionVar(exists='tweener_interp_type_id'):
-        idx = int(cmds.optionVar(q='tweener_interp_type_id'))
-    else:
-        idx = 0
+    idx = int(store.get('tweener_interp_type_id'))
     
     for m in BlendingMode.modes:
         if idx == m.idx:
@@ -70,7 +92,7 @@ def save_overshoot(value=False):
     Saves the overshoot state using Maya optionVars.
     :param value: Current state of the overshoot toggle
     """
-    cmds.optionVar(iv=('tweener_overshoot', int(value)))
+    store.set('tweener_overshoot', bool(value))
 
 
 def load_overshoot():
@@ -79,10 +101,7 @@ def load_overshoot():
     :return: The loaded toggle state
     :rtype: bool
     """
-    if cmds.optionVar(exists='tweener_overshoot'):
-        return bool(cmds.optionVar(q='tweener_overshoot'))
-    
-    return False
+    return bool(store.get('tweener_overshoot'))
 
 
 def save_live_preview(value=True):
@@ -91,7 +110,7 @@ def save_live_preview(value=True):
     :param value: Current state of the live preview toggle
     :return:
     """
-    cmds.optionVar(iv=('tweener_live_preview', int(value)))
+    store.set('tweener_live_preview', bool(value))
 
 
 def load_live_preview():
@@ -100,10 +119,7 @@ def load_live_preview():
     :return:  The loaded live preview state
     :rtype: bool
     """
-    if cmds.optionVar(exists='tweener_live_preview'):
-        return bool(cmds.optionVar(q='tweener_live_preview'))
-    
-    return True
+    return bool(store.get('tweener_live_preview'))
 
 
 def save_toolbar(visible=True):
@@ -111,7 +127,7 @@ def save_toolbar(visible=True):
     Saves the visibility of window buttons
     :param visible: Whether the toolbar is visible
     """
-    cmds.optionVar(iv=('tweener_toolbar', int(visible)))
+    store.set('tweener_toolbar', bool(visible))
 
 
 def load_toolbar():
@@ -119,10 +135,7 @@ def load_toolbar():
     Loads the visibility of the toolbar
     :rtype: bool
     """
-    if cmds.optionVar(exists='tweener_toolbar'):
-        return bool(cmds.optionVar(q='tweener_toolbar'))
-    
-    return True  # default
+    return bool(store.get('tweener_toolbar'))
 
 
 def save_presets(visible=True):
@@ -130,7 +143,7 @@ def save_presets(visible=True):
     Saves the visibility of the preset buttons
     :param visible: Whether the preset buttons are visible
     """
-    cmds.optionVar(iv=('tweener_presets', int(visible)))
+    store.set('tweener_presets', bool(visible))
 
 
 def load_presets():
@@ -138,10 +151,7 @@ def load_presets():
     Loads the visibility of the preset buttons
     :rtype: bool
     """
-    if cmds.optionVar(exists='tweener_presets'):
-        return bool(cmds.optionVar(q='tweener_presets'))
-    
-    return True  # default
+    return bool(store.get('tweener_presets'))
 
 
 def save_tick_draw_special(visible=True):
@@ -149,7 +159,7 @@ def save_tick_draw_special(visible=True):
     Saves the visibility of the preset buttons
     :param visible: Whether the preset buttons are visible
     """
-    cmds.optionVar(iv=('tweener_tick_draw_special', int(visible)))
+    store.set('tweener_tick_draw_special', bool(visible))
 
 
 def load_tick_draw_special():
@@ -157,7 +167,167 @@ def load_tick_draw_special():
     Loads the visibility of the preset buttons
     :rtype: bool
     """
-    if cmds.optionVar(exists='tweener_tick_draw_special'):
-        return bool(cmds.optionVar(q='tweener_tick_draw_special'))
+    return bool(store.get('tweener_tick_draw_special'))
+
+
+def save_keyhammer_preserve_shape(value=False):
+    """
+    Saves whether key hammer preserves the curve shape
+    :param value: Whether key hammer splits curve segments
+    """
+    store.set('tweener_keyhammer_preserve_shape', bool(value))
+
+
+def load_keyhammer_preserve_shape():
+    """
+    Loads whether key hammer preserves the curve shape
+    :rtype: bool
+    """
+    return bool(store.get('tweener_keyhammer_preserve_shape'))
+
+
+def save_keyhammer_layer_scope(scope='best'):
+    """
+    Saves which animation layers key hammer keys
+    :param scope: One of the key hammer layer scopes: 'best', 'selected' or 'all'
+    """
+    store.set('tweener_keyhammer_layer_scope', str(scope))
+
+
+def load_keyhammer_layer_scope():
+    """
+    Loads which animation layers key hammer keys
+    :rtype: str
+    """
+    return str(store.get('tweener_keyhammer_layer_scope'))
+
+
+def save_refresh_policy(policy='affected'):
+    """
+    Saves which views live preview redraws
+    :param policy: One of the refresh policies: 'active', 'visible', 'affected' or 'all'
+    """
+    store.set('tweener_refresh_policy', str(policy))
+
+
+def load_refresh_policy():
+    """
+    Loads which views live preview redraws
+    :rtype: str
+    """
+    return str(store.get('tweener_refresh_policy'))
+
+
+def save_preview_lod(value=False):
+    """
+    Saves whether live preview updates the visible curves first
+    :param value: Whether live preview uses level of detail
+    """
+    store.set('tweener_preview_lod', bool(value))
+
+
+def load_preview_lod():
+    """
+    Loads whether live preview updates the visible curves first
+    :rtype: bool
+    """
+    return bool(store.get('tweener_preview_lod'))
+
+
+def save_preview_shadow(value=False):
+    """
+    Saves whether live preview sets the pose instead of editing keys at the current frame
+    :param value: Whether live preview uses the shadow buffer
+    """
+    store.set('tweener_preview_shadow', bool(value))
+
+
+def load_preview_shadow():
+    """
+    Loads whether live preview sets the pose instead of editing keys at the current frame
+    :rtype: bool
+    """
+    return bool(store.get('tweener_preview_shadow'))
+
+
+class OptionsStore(object):
+    """
+    Serves the Tweener optionVars from memory.
     
-    return False  # default
+    All optionVars are read on first use. Changes are kept in memory and written back in one batch when Maya is idle,
+    or when flush is called. optionVars only change outside of Tweener when another session's prefs are loaded, so
+    reload is called when the plug-in is loaded.
+    """
+    
+    def __init__(self):
+        self.__values = None
+        self.__dirty = set()
+        self.__flush_scheduled = False
+    
+    def reload(self):
+        """
+        Writes pending changes and reads all optionVars again on next use.
+        """
+        self.flush()
+        self.__values = None
+    
+    def load(self):
+        """
+        Reads all optionVars into memory.
+        """
+        self.__values = {}
+        for name, default in OPTION_DEFAULTS.items():
+            if cmds.optionVar(exists=name):
+                self.__values[name] = cmds.optionVar(q=name)
+            else:
+                self.__values[name] = default
+    
+    def get(self, name):
+        """
+        Get the value of an optionVar, without querying Maya.
+        
+        :param name: optionVar name, one of OPTION_DEFAULTS
+        :type name: str
+        """
+        if self.__values is None:
+            self.load()
+        
+        return self.__values[name]
+    
+    def set(self, name, value):
+        """
+        Sets the value of an optionVar in memory and schedules the write to Maya.
+        
+        :param name: optionVar name, one of OPTION_DEFAULTS
+        :type name: str
+        """
+        if self.__values is None:
+            self.load()
+        
+        if self.__values[name] == value:
+            return
+        
+        self.__values[name] = value
+        self.__dirty.add(name)
+        
+        if not self.__flush_scheduled:
+            self.__flush_scheduled = True
+            cmds.evalDeferred(self.flush, lowestPriority=True)
+    
+    def flush(self):
+        """
+        Writes all changed values to the optionVars.
+        """
+        self.__flush_scheduled = False
+        
+        for name in self.__dirty:
+            value = self.__values[name]
+            if isinstance(OPTION_DEFAULTS[name], str):
+                cmds.optionVar(sv=(name, str(value)))
+            else:
+                cmds.optionVar(iv=(name, int(value)))
+        
+        self.__dirty = set()
+
+
+store = OptionsStore()
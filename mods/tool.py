@@ -5,15 +5,22 @@ Tool
 - The tool can also be assigned a hotkey using the tweenerTool command.
 """
 import sys
+import time
 
+import maya.api.OpenMaya as om
 import maya.cmds as cmds
 
+from PySide2.QtCore import QEvent, QObject, Qt
+from PySide2.QtWidgets import QApplication
+
 if sys.version_info >= (3, 0):
+    import mods.animdata as animdata
     import mods.globals as g
     import mods.options as options
     import mods.tween as tween
     import mods.utils as utils
 else:
+    import animdata as animdata
     import globals as g
     import options as options
     import tween as tween
@@ -21,6 +28,11 @@ else:
 
 tool = None
 
+# the drag preview runs at most once per budget, which adapts to the measured cost of a preview
+DRAG_MIN_BUDGET = 1.0 / 60.0
+DRAG_MAX_BUDGET = 0.1
+UPDATE_TIME_SMOOTHING = 0.3
+
 
 def reset():
     """
@@ -36,6 +48,8 @@ def activate():
     """
     global tool
     if tool is None:
+        # the context is created on first use instead of on import
+        reset()
         tool = Tool()
     
     cmds.setToolTo('tweenerToolContext')
@@ -52,6 +66,11 @@ class Tool:
         """
         self.press_position = [0, 0, 0]
         self.drag_position = [0, 0, 0]
+        self.scheduler = DragScheduler(self.preview)
+        self.views = None
+        self.preview_writer = tween.LivePreview()
+        self.cancel_filter = CancelFilter(self.cancel)
+        self.cancelled = False
         
         self.interpolation_mode = options.load_interpolation_mode()
         self.overshoot = options.load_overshoot()
@@ -85,6 +104,13 @@ class Tool:
         self.interpolation_mode = options.load_interpolation_mode()
         self.overshoot = options.load_overshoot()
         self.live_preview = options.load_live_preview()
+        self.refresh_policy = options.load_refresh_policy()
+        
+        self.scheduler.stop()
+        
+        # esc or right-click cancels the gesture
+        self.cancelled = False
+        self.cancel_filter.install()
         
         # disable undo on first call, so we don't get 2 undos in queue
         # both press and release add to the same cache, so it should be safe
@@ -93,26 +119,45 @@ class Tool:
             cmds.tweener(t=0.0, newCache=True, type=self.interpolation_mode.idx)
             cmds.undoInfo(stateWithoutFlush=True)
             
-            tween.interpolate(blend=0.0, mode=self.interpolation_mode)
-            cmds.refresh()
+            # find the views to redraw once per gesture
+            self.views = utils.get_views_to_refresh(self.refresh_policy, list(animdata.curve_key_values.keys()))
+            self.preview_writer.prepare(lod=options.load_preview_lod(), shadow=options.load_preview_shadow())
+            
+            self.preview_writer.interpolate(blend=0.0, mode=self.interpolation_mode)
+            utils.refresh_views(self.views)
     
     def drag(self):
         """
         Dragger context drag event handler.
         """
+        if self.cancelled:
+            return
+        
         self.drag_position = cmds.draggerContext('tweenerToolContext',
                                                  q=True,
                                                  dragPoint=True)
         
         if self.live_preview:
-            blend = self.get_blend()
-            tween.interpolate(blend=blend, mode=self.interpolation_mode)
-            cmds.refresh()
+            self.scheduler.submit(self.get_blend())
+    
+    def preview(self, blend):
+        """
+        Interpolates and redraws, called by the drag scheduler with the latest blend value.
+        """
+        self.preview_writer.interpolate(blend=blend, mode=self.interpolation_mode)
+        utils.refresh_views(self.views)
     
     def release(self):
         """
         Dragger context release event handler.
         """
+        # the release applies the final blend, so pending previews are stale
+        self.scheduler.stop()
+        self.cancel_filter.remove()
+        
+        if self.cancelled:
+            return
+        
         blend = self.get_blend()
         if self.live_preview:
             cmds.tweener(t=blend, newCache=False, type=self.interpolation_mode.idx)
@@ -121,6 +166,17 @@ class Tool:
             
         cmds.refresh()
         
+    def cancel(self):
+        """
+        Cancels the gesture, restoring the keys as they were before the press.
+        """
+        self.scheduler.stop()
+        self.cancelled = True
+        
+        if self.live_preview:
+            tween.cancel()
+            utils.refresh_views(self.views)
+    
     def finalize(self):
         """
         Dragger context finalize event handler.
@@ -147,4 +203,111 @@ class Tool:
         return blend
 
 
-reset()
+class CancelFilter(QObject):
+    """
+    Application event filter that cancels a gesture when Esc or the right mouse button is pressed.
+    """
+    
+    def __init__(self, cancel):
+        """
+        :param cancel: Function that cancels the gesture
+        :type cancel: function
+        """
+        super(CancelFilter, self).__init__()
+        self.cancel = cancel
+        self.installed = False
+    
+    def install(self):
+        if not self.installed:
+            QApplication.instance().installEventFilter(self)
+            self.installed = True
+    
+    def remove(self):
+        if self.installed:
+            QApplication.instance().removeEventFilter(self)
+            self.installed = False
+    
+    def eventFilter(self, obj, event):
+        is_escape = event.type() == QEvent.KeyPress and event.key() == Qt.Key_Escape
+        is_right_click = event.type() == QEvent.MouseButtonPress and event.button() == Qt.RightButton
+        
+        if is_escape or is_right_click:
+            self.remove()
+            self.cancel()
+            return True  # consume the event, so it does not open a menu or leave the tool
+        
+        return False
+
+
+class DragScheduler:
+    """
+    Coalesces drag events, so only the latest value is previewed.
+    
+    A value is previewed right away if the last preview is older than the budget. Otherwise it replaces any pending
+    value and is previewed on the next idle event, so intermediate values are skipped when previews are slower than
+    the mouse. The budget follows the measured preview time.
+    """
+    
+    def __init__(self, update):
+        """
+        :param update: Function that previews a value
+        :type update: function
+        """
+        self.update = update
+        self.budget = DRAG_MIN_BUDGET
+        self.update_time = None  # smoothed seconds spent in update
+        self.pending = None
+        self.last_run = 0.0
+        self.callback_id = None
+    
+    def submit(self, value):
+        """
+        Previews the value now, or when Maya is idle if the budget has not passed since the last preview.
+        """
+        self.pending = value
+        
+        if time.time() - self.last_run >= self.budget:
+            self.flush()
+        elif self.callback_id is None:
+            self.callback_id = om.MEventMessage.addEventCallback('idle', self.on_idle)
+    
+    def flush(self):
+        """
+        Previews the pending value, if any, and adapts the budget to the time it took.
+        """
+        self.remove_callback()
+        
+        if self.pending is None:
+            return
+        
+        value = self.pending
+        self.pending = None
+        
+        start_time = time.time()
+        self.update(value)
+        self.last_run = time.time()
+        
+        self.update_time = self.smooth(self.update_time, self.last_run - start_time)
+        self.budget = min(max(self.update_time, DRAG_MIN_BUDGET), DRAG_MAX_BUDGET)
+    
+    def on_idle(self, *args):
+        self.flush()
+    
+    def stop(self):
+        """
+        Discards the pending value.
+        """
+        self.remove_callback()
+        self.pending = None
+    
+    def remove_callback(self):
+        if self.callback_id is not None:
+            om.MMessage.removeCallback(self.callback_id)
+            self.callback_id = None
+    
+    @staticmethod
+    def smooth(average, value):
+        if average is None:
+            return value
+        
+        return average + (value - average) * UPDATE_TIME_SMOOTHING
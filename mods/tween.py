@@ -2,78 +2,102 @@
 tween module - the methods that does the actual work
 """
 import sys
+import time
 
 import maya.api.OpenMaya as om
+import maya.api.OpenMayaAnim as oma
 import maya.cmds as cmds
 
 if sys.version_info >= (3, 0):
     import mods.utils as utils
     import mods.animdata as animdata
+    import mods.animlayers as animlayers
     import mods.options as options
 else:
     import utils as utils
     import animdata as animdata
+    import animlayers as animlayers
     import options as options
 
 
+# seconds between updates of the curves that are not visible, when previewing with level of detail
+PREVIEW_LOD_INTERVAL = 0.25
+
+
 def maya_useNewAPI():
     pass
 
 
-def interpolate(blend, mode):
+def interpolate(blend, mode, curve_key_values=None, set_value=None):
     """
     Gateway for calling the function based on interpolation type.
+    
+    :param curve_key_values: Subset of animdata.curve_key_values to interpolate, None for all
+    :type curve_key_values: dict or None
+    :param set_value: Function that writes a key value, defaults to set_key_value
+    :type set_value: function or None
     """
     
+    if curve_key_values is None:
+        curve_key_values = animdata.curve_key_values
+    
+    if set_value is None:
+        set_value = set_key_value
+    
     if mode == options.BlendingMode.between:
-        interpolate_between(blend)
+        interpolate_between(blend, curve_key_values, set_value)
     
     elif mode == options.BlendingMode.towards:
-        interpolate_towards(blend)
+        interpolate_towards(blend, curve_key_values, set_value)
     
     elif mode == options.BlendingMode.average:
-        interpolate_average(blend)
+        interpolate_average(blend, curve_key_values, set_value)
     
     elif mode == options.BlendingMode.curve:
-        interpolate_curve_tangent(blend)
+        interpolate_curve_tangent(blend, curve_key_values, set_value)
     
     elif mode == options.BlendingMode.default:
-        interpolate_default(blend)
+        interpolate_default(blend, curve_key_values, set_value)
 
 
-def interpolate_between(t):
+def set_key_value(curve_fn, index, value):
+    """
+    Writes a key value to the curve, recorded in the animation cache.
+    """
+    curve_fn.setValue(index, value, change=animdata.anim_cache)
+
+
+def interpolate_between(t, curve_key_values, set_value):
     """
     Linearly interpolate between neighbouring values.
     """
     
-    for curve_fn, key_group in animdata.curve_key_values.items():
+    for curve_fn, key_group in curve_key_values.items():
         for i in range(len(key_group.key_index)):
             new_value = lerp_between(key_group.prev_value[i],
                                      key_group.next_value[i], t)
-            curve_fn.setValue(key_group.key_index[i], new_value,
-                              change=animdata.anim_cache)
+            set_value(curve_fn, key_group.key_index[i], new_value)
 
 
-def interpolate_towards(t):
+def interpolate_towards(t, curve_key_values, set_value):
     """
     Interpolate towards the neighbouring values, based on current value.
     """
     
-    for curve_fn, key_group in animdata.curve_key_values.items():
+    for curve_fn, key_group in curve_key_values.items():
         for i in range(len(key_group.key_index)):
             new_value = lerp_towards(key_group.prev_value[i],
                                      key_group.next_value[i], t,
                                      key_group.value[i])
-            curve_fn.setValue(key_group.key_index[i], new_value,
-                              change=animdata.anim_cache)
+            set_value(curve_fn, key_group.key_index[i], new_value)
 
 
-def interpolate_average(t):
+def interpolate_average(t, curve_key_values, set_value):
     """
     Interpolate towards or away from the average value
     """
     
-    for curve_fn, key_group in animdata.curve_key_values.items():
+    for curve_fn, key_group in curve_key_values.items():
         length = len(key_group.key_index)
         is_single = length < 2
         avg_val = 0
@@ -85,11 +109,10 @@ def interpolate_average(t):
                     i]) * 0.5
             prev_val = key_group.value[i] * 2 - avg_val
             new_value = lerp_towards(prev_val, avg_val, t, key_group.value[i])
-            curve_fn.setValue(key_group.key_index[i], new_value,
-                              change=animdata.anim_cache)
+            set_value(curve_fn, key_group.key_index[i], new_value)
 
 
-def interpolate_curve_tangent(t):
+def interpolate_curve_tangent(t, curve_key_values, set_value):
     """
     Interpolate based on key tangents.
     """
@@ -113,7 +136,7 @@ def interpolate_curve_tangent(t):
     t2p2 = 3 * pow(t2, 2) * (1 - t2)
     t2p3 = pow(t2, 3)
     
-    for curve_fn, key_group in animdata.curve_key_values.items():
+    for curve_fn, key_group in curve_key_values.items():
         for i in range(len(key_group.key_index)):
             if key_group.has_two_segments[i]:
                 if t < 0.5:
@@ -129,16 +152,15 @@ def interpolate_curve_tangent(t):
                 new_value = tp0 * p[0].y + tp1 * p[1].y + tp2 * p[2].y + tp3 * \
                             p[3].y
             
-            curve_fn.setValue(key_group.key_index[i], new_value,
-                              animdata.anim_cache)
+            set_value(curve_fn, key_group.key_index[i], new_value)
 
 
-def interpolate_default(t):
+def interpolate_default(t, curve_key_values, set_value):
     """
     Interpolate towards or away from the attributes default value.
     """
     
-    for curve_fn, key_group in animdata.curve_key_values.items():
+    for curve_fn, key_group in curve_key_values.items():
         for i in range(len(key_group.key_index)):
             if key_group.default_value is None:
                 continue
@@ -147,8 +169,129 @@ def interpolate_default(t):
                 key_group.value[i] * 2 - key_group.default_value,
                 key_group.default_value,
                 t, key_group.value[i])
-            curve_fn.setValue(key_group.key_index[i], new_value,
-                              change=animdata.anim_cache)
+            set_value(curve_fn, key_group.key_index[i], new_value)
+
+
+def cancel():
+    """
+    Cancels the current gesture. The original key values are restored from the snapshot taken by prepare, keys added
+    by prepare are removed and the changes recorded so far are thrown away, instead of undoing them one by one.
+    """
+    
+    for curve_fn, key_group in animdata.curve_key_values.items():
+        for i in range(len(key_group.key_index)):
+            curve_fn.setValue(key_group.key_index[i], key_group.value[i])
+    
+    for curve_fn, times in animdata.added_keys.items():
+        indices = [curve_fn.find(mtime) for mtime in times]
+        
+        # remove from the end, so the indices stay valid
+        for index in sorted((i for i in indices if i is not None), reverse=True):
+            curve_fn.remove(index)
+    
+    if animdata.tick_modifier is not None:
+        animdata.tick_modifier.undoIt()
+    
+    animdata.anim_cache = None
+    animdata.tick_modifier = None
+    animdata.curve_key_values = {}
+    animdata.added_keys = {}
+
+
+class LivePreview(object):
+    """
+    Writes the live preview of a gesture, optionally with level of detail and a shadow buffer.
+    
+    Level of detail writes the curves driving objects in the active view (or the curves selected in a visible graph
+    editor) on every tick, and the remaining curves every PREVIEW_LOD_INTERVAL seconds.
+    
+    The shadow buffer does not edit the curves while dragging. Curves with a single key at the current time, that
+    drive a plug directly, get the value set on that plug instead, so ticks do not dirty the animation or fill the
+    undo cache. Other curves are written as usual.
+    
+    The tweener command writes all curves on release, so the final result does not depend on either option.
+    """
+    
+    def __init__(self):
+        self.lod = False
+        self.visible = None
+        self.hidden = None
+        self.hidden_time = 0.0
+        self.shadow_plugs = {}
+    
+    def prepare(self, lod=False, shadow=False):
+        """
+        Splits the prepared curves and finds the shadow plugs, once per gesture.
+        """
+        self.lod = lod
+        self.visible = None
+        self.hidden = None
+        self.shadow_plugs = get_shadow_plugs() if shadow else {}
+        
+        if lod:
+            self.visible, self.hidden = animdata.split_visible_curve_key_values()
+            self.hidden_time = 0.0
+    
+    def interpolate(self, blend, mode):
+        """
+        Interpolates the visible curves, and the hidden curves if they are due.
+        """
+        if not self.lod:
+            interpolate(blend=blend, mode=mode, set_value=self.set_value)
+            return
+        
+        interpolate(blend=blend, mode=mode, curve_key_values=self.visible, set_value=self.set_value)
+        
+        now = time.time()
+        if self.hidden and now - self.hidden_time >= PREVIEW_LOD_INTERVAL:
+            self.hidden_time = now
+            interpolate(blend=blend, mode=mode, curve_key_values=self.hidden, set_value=self.set_value)
+    
+    def set_value(self, curve_fn, index, value):
+        plug = self.shadow_plugs.get(curve_fn)
+        if plug is None:
+            set_key_value(curve_fn, index, value)
+            return
+        
+        try:
+            plug.setDouble(value)
+        except RuntimeError:
+            # setting a plug that has an incoming connection only works in some evaluation modes, as the connected
+            # curve may win when the plug is evaluated. if it is refused, write this curve from now on
+            del self.shadow_plugs[curve_fn]
+            set_key_value(curve_fn, index, value)
+
+
+def get_shadow_plugs():
+    """
+    Finds the plugs that can show the preview of a curve without editing it. That is when the curve has a single key
+    at the current time and drives a plug directly.
+    
+    :return: Dictionary of curves and the plugs they drive
+    :rtype: dict
+    """
+    shadow_plugs = {}
+    current_time = oma.MAnimControl.currentTime()
+    
+    for curve_fn, key_group in animdata.curve_key_values.items():
+        if len(key_group.key_index) != 1 or curve_fn.animCurveType == oma.MFnAnimCurve.kAnimCurveTT:
+            continue
+        
+        if curve_fn.input(key_group.key_index[0]) != current_time:
+            continue
+        
+        # layer blend nodes and pairBlends would mix the value with their other inputs
+        destinations = curve_fn.findPlug('output', True).destinations()
+        if len(destinations) != 1 or destinations[0].isLocked:
+            continue
+        
+        node = destinations[0].node()
+        if node.apiType() in animlayers.BLEND_NODE_TYPES or node.hasFn(om.MFn.kPairBlend):
+            continue
+        
+        shadow_plugs[curve_fn] = destinations[0]
+    
+    return shadow_plugs
 
 
 def lerp_between(a, b, t):
@@ -189,52 +332,114 @@ def lerp_towards(a, b, t, current):
         return current
 
 
-def tick_draw_special(special=True):
-    """
-    Makes the currently selected keyframes use the special tick color
+def tick_draw_special(special=True, modifier=None):
     """
+    Makes the currently selected keyframes use the special tick color.
     
-    # set tick color of selected keys in graph editor or dopesheet
-    if utils.is_graph_editor_or_dope_sheet():
-        cmds.keyframe(tds=special)
-        return
-
-    # check if any keys are selected (not allowed when setting tds on time range)
-    sl_list = om.MGlobal.getActiveSelectionList()
-    it = om.MItSelectionList(sl_list, om.MFn.kAnimCurve)
+    Keys selected in the graph editor or dope sheet are used, otherwise the keys of the selected objects in the time
+    slider range.
     
-    # clear the active key selection (if needed)
-    if not it.isDone():
-        cmds.selectKey(clear=True)
+    :param special: Use the special tick color?
+    :type special: bool
+    :param modifier: Records the change for undo, if given
+    :type modifier: maya.api.OpenMaya.MDGModifier or None
+    """
     
-    # color the keys on the time slider
-    time_range = utils.get_time_slider_range()
-    cmds.keyframe(tds=special, t=time_range)
+    curve_indices = []
     
-    # restore previous selection (if needed)
-    if not it.isDone():
-        om.MGlobal.setActiveSelectionList(sl_list)
+    if utils.is_graph_editor_or_dope_sheet():
+        # selected keys in graph editor or dopesheet
+        for curve in utils.get_selected_anim_curves():
+            curve_fn = oma.MFnAnimCurve(curve)
+            indices = cmds.keyframe(str(curve_fn.absoluteName()), q=True, selected=True, indexValue=True)
+            if indices:
+                curve_indices.append((curve_fn, indices))
+    else:
+        # keys on the time slider, of all animated attributes like cmds.keyframe, not only the channel box selection
+        time_range = utils.get_time_slider_range()
+        curves, plugs = utils.get_anim_curves_from_objects(utils.get_selected_objects(), use_channelbox=False)
+        for curve in curves:
+            curve_fn = oma.MFnAnimCurve(curve)
+            curve_indices.append((curve_fn, get_key_indices_in_range(curve_fn, time_range[0], time_range[1])))
+    
+    set_tick_draw_special(curve_indices, special, modifier)
 
 
 def tick_draw_special_custom(special):
     """
     Makes the current set of keys use the special tick color, using the Python API.
     
-    Important: NOT undoable!
+    The change is recorded in the tweener command that prepared the keys, so it is undone with the tween.
     
     :param special: Use the special tick color?
     :type special: bool
     """
     
+    curve_indices = [(curve_fn, key_group.key_index) for curve_fn, key_group in animdata.curve_key_values.items()]
+    set_tick_draw_special(curve_indices, special, animdata.tick_modifier)
+
+
+def set_tick_draw_special(curve_indices, special, modifier=None):
+    """
+    Sets the tick color of keys. The tick plug is found once per curve and each key is written once.
+    
+    :param curve_indices: Animation curves with the key indices to set
+    :type curve_indices: list of (maya.api.OpenMayaAnim.MFnAnimCurve, list of int)
+    :param special: Use the special tick color?
+    :type special: bool
+    :param modifier: Records the change for undo, if given. Otherwise the change cannot be undone
+    :type modifier: maya.api.OpenMaya.MDGModifier or None
+    """
+    
     try:
-        for curve_fn, key_group in animdata.curve_key_values.items():
-            for i in range(len(key_group.key_index)):
-                node_fn = om.MFnDependencyNode(curve_fn.object())
-                if node_fn.hasAttribute('kyts'):
-                    plug = node_fn.findPlug('kyts', True)
-                    if plug.isArray:
-                        for index in key_group.key_index:
-                            array_plug = plug.elementByLogicalIndex(index)
-                            array_plug.setBool(special)
+        for curve_fn, indices in curve_indices:
+            if not indices or not curve_fn.hasAttribute('kyts'):
+                continue
+            
+            plug = curve_fn.findPlug('kyts', True)
+            if not plug.isArray:
+                continue
+            
+            for index in set(indices):
+                element_plug = plug.elementByLogicalIndex(index)
+                if modifier is None:
+                    element_plug.setBool(special)
+                else:
+                    modifier.newPlugValueBool(element_plug, special)
+        
+        if modifier is not None:
+            modifier.doIt()
     except Exception as e:
         sys.stderr.write('%s\n' % str(e))
+
+
+def get_key_indices_in_range(curve_fn, start, end):
+    """
+    Get the indices of the keys from start to end, both included.
+    
+    :param curve_fn: Animation curve
+    :type curve_fn: maya.api.OpenMayaAnim.MFnAnimCurve
+    :param start: Start time in the current time unit
+    :type start: float
+    :param end: End time in the current time unit
+    :type end: float
+    :rtype: list of int
+    """
+    
+    num_keys = curve_fn.numKeys
+    if num_keys == 0:
+        return []
+    
+    unit = om.MTime.uiUnit()
+    index = curve_fn.findClosest(om.MTime(start, unit))
+    
+    # closest may be the key just before start
+    if curve_fn.input(index).asUnits(unit) < start - animdata.TIME_TOLERANCE:
+        index += 1
+    
+    indices = []
+    while index < num_keys and curve_fn.input(index).asUnits(unit) <= end + animdata.TIME_TOLERANCE:
+        indices.append(index)
+        index += 1
+    
+    return indices
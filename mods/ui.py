@@ -3,9 +3,9 @@ ui module
 """
 import sys
 import os
+import time
+from collections import deque
 
-import maya.api.OpenMaya as om
-import maya.api.OpenMayaUI as omui2
 import maya.OpenMayaUI as omui
 import maya.cmds as cmds
 import maya.mel as mel
@@ -19,16 +19,38 @@ from PySide2.QtWidgets import *
 from shiboken2 import wrapInstance
 
 if sys.version_info >= (3, 0):
+    import mods.animdata as animdata
     import mods.globals as g
     import mods.options as options
+    import mods.tool as tool
     import mods.tween as tween
+    import mods.utils as utils
 else:
+    import animdata as animdata
     import globals as g
     import options as options
+    import tool as tool
     import tween as tween
+    import utils as utils
 
 tweener_window = None
 
+# session caches, so reopening the window does not reload icons or query the dpi setting again
+dpi_scale = None
+icon_cache = {}
+preset_pixmap_cache = {}
+
+# live preview runs from a timer, which coalesces the slider values between ticks.
+# the interval follows the average tick time, so input events are handled between slow ticks
+PREVIEW_MIN_INTERVAL = 16  # milliseconds
+PREVIEW_MAX_INTERVAL = 100  # milliseconds
+
+# number of ticks in the rolling average of the preview timings
+PREVIEW_STATS_SIZE = 30
+
+# seconds between updates of the timings label while dragging
+PREVIEW_STATS_INTERVAL = 0.25
+
 
 def maya_useNewAPI():
     pass
@@ -101,10 +123,16 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
         # self.setProperty("saveWindowPref", True)
         
         # variables
-        self.idle_callback = None
         self.dragging = False
-        self.busy = False
+        self.ticking = False
+        self.pending_value = None
+        self.stats = PreviewStats()
+        self.stats_time = 0.0
         self.live_preview = True
+        self.views = None
+        self.preview_writer = tween.LivePreview()
+        self.cancel_filter = tool.CancelFilter(self.cancel_gesture)
+        self.cancelled = False
         
         # define window dimensions
         self.setMinimumWidth(apply_dpi_scaling(418))
@@ -296,6 +324,9 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
         self.slider.setMaximum(10000)
         self.slider.setTickInterval(1)
         
+        self.preview_timer = QTimer(self)
+        self.preview_timer.timeout.connect(self.preview_tick)
+        
         self.slider.sliderPressed.connect(self.slider_pressed)
         self.slider.valueChanged.connect(self.slider_changed)
         self.slider.sliderReleased.connect(self.slider_released)
@@ -341,7 +372,13 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
         version_label.setAlignment(Qt.AlignRight | Qt.AlignBottom)
         version_label.setStyleSheet('color: rgba(255, 255, 255, 54); font-size: %spx;' % (apply_dpi_scaling(10)))
         
-        slider_label_layout.addWidget(QWidget())  # empty widget to balance layout
+        # rolling average of the live preview timings, also balances the layout
+        self.stats_label = QLabel('')
+        self.stats_label.setAlignment(Qt.AlignLeft | Qt.AlignBottom)
+        self.stats_label.setStyleSheet('color: rgba(255, 255, 255, 54); font-size: %spx;' % (apply_dpi_scaling(10)))
+        self.stats_label.setToolTip('Average live preview time per tick: interpolation | viewport refresh')
+        
+        slider_label_layout.addWidget(self.stats_label)
         slider_label_layout.addWidget(self.slider_label)
         slider_label_layout.addWidget(version_label)
         
@@ -369,6 +406,47 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
         self.tick_draw_special_action.setCheckable(True)
         self.tick_draw_special_action.triggered.connect(self.popup_tick_draw_special_clicked)
         
+        self.keyhammer_preserve_shape_action = self.popupMenu.addAction("Key Hammer Preserves Curve Shape")
+        self.keyhammer_preserve_shape_action.setCheckable(True)
+        self.keyhammer_preserve_shape_action.triggered.connect(self.popup_keyhammer_preserve_shape_clicked)
+        
+        self.keyhammer_layer_menu = self.popupMenu.addMenu("Key Hammer Layers")
+        self.keyhammer_layer_group = QActionGroup(self.keyhammer_layer_menu)
+        self.keyhammer_layer_actions = {}
+        for scope, label in [('best', 'Active Layer per Attribute'),
+                             ('selected', 'Selected Layers'),
+                             ('all', 'All Layers')]:
+            action = self.keyhammer_layer_menu.addAction(label)
+            action.setCheckable(True)
+            action.triggered.connect(lambda checked=False, s=scope: options.save_keyhammer_layer_scope(s))
+            self.keyhammer_layer_group.addAction(action)
+            self.keyhammer_layer_actions[scope] = action
+        
+        self.refresh_policy_menu = self.popupMenu.addMenu("Live Preview Refresh")
+        self.refresh_policy_group = QActionGroup(self.refresh_policy_menu)
+        self.refresh_policy_actions = {}
+        for policy, label in [(utils.REFRESH_ACTIVE, 'Active View'),
+                              (utils.REFRESH_VISIBLE, 'All Visible Views'),
+                              (utils.REFRESH_AFFECTED, 'Views Showing Animated Objects'),
+                              (utils.REFRESH_ALL, 'All Panels')]:
+            action = self.refresh_policy_menu.addAction(label)
+            action.setCheckable(True)
+            action.triggered.connect(lambda checked=False, p=policy: options.save_refresh_policy(p))
+            self.refresh_policy_group.addAction(action)
+            self.refresh_policy_actions[policy] = action
+        
+        self.refresh_policy_menu.addSeparator()
+        self.preview_lod_action = self.refresh_policy_menu.addAction("Visible Objects First")
+        self.preview_lod_action.setCheckable(True)
+        self.preview_lod_action.setToolTip('Objects outside the active view are updated less often while dragging')
+        self.preview_lod_action.triggered.connect(self.popup_preview_lod_clicked)
+        
+        self.preview_shadow_action = self.refresh_policy_menu.addAction("Preview Without Editing Keys")
+        self.preview_shadow_action.setCheckable(True)
+        self.preview_shadow_action.setToolTip('When tweening the current frame, the pose is previewed and keys are '
+                                              'only changed on release')
+        self.preview_shadow_action.triggered.connect(self.popup_preview_shadow_clicked)
+        
         self.load_preferences()
         self.set_mode_button()
     
@@ -386,6 +464,15 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
     def popup_tick_draw_special_clicked(self, checked):
         options.save_tick_draw_special(checked)
     
+    def popup_keyhammer_preserve_shape_clicked(self, checked):
+        options.save_keyhammer_preserve_shape(checked)
+    
+    def popup_preview_lod_clicked(self, checked):
+        options.save_preview_lod(checked)
+    
+    def popup_preview_shadow_clicked(self, checked):
+        options.save_preview_shadow(checked)
+    
     def slider_pressed(self):
         self.dragging = True
         slider_value = self.slider.value() / 100.0
@@ -394,8 +481,15 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
         
         self.interpolation_mode = self.mode_button_group.checkedButton().mode()
         
-        # only update when maya is idle to prevent multiple calls without seeing the result
-        self.idle_callback = om.MEventMessage.addEventCallback('idle', self.slider_changed)
+        # slider values are previewed by the timer, which skips values that are replaced before the next tick
+        self.pending_value = None
+        self.stats.reset()
+        self.preview_timer.setInterval(PREVIEW_MIN_INTERVAL)
+        self.preview_timer.start()
+        
+        # esc or right-click cancels the gesture
+        self.cancelled = False
+        self.cancel_filter.install()
         
         if self.live_preview:
             # disable undo on first call, so we don't get 2 undos in queue
@@ -404,16 +498,20 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
             cmds.tweener(t=blend, newCache=True, type=self.interpolation_mode.idx)
             cmds.undoInfo(stateWithoutFlush=True)
             
-            tween.interpolate(blend=blend, mode=self.interpolation_mode)
+            # find the views to redraw once per gesture
+            self.views = utils.get_views_to_refresh(options.load_refresh_policy(),
+                                                    list(animdata.curve_key_values.keys()))
+            self.preview_writer.prepare(lod=options.load_preview_lod(), shadow=options.load_preview_shadow())
+            
+            self.preview_writer.interpolate(blend=blend, mode=self.interpolation_mode)
             
             if options.load_tick_draw_special():
                 tween.tick_draw_special_custom(special=True)
     
     def slider_changed(self, *args):
-        if self.busy or not self.dragging:
+        if not self.dragging:
             return
         
-        self.busy = True
         slider_value = self.slider.value() / 100.0
         
         if self.interpolation_mode == options.BlendingMode.between:
@@ -425,18 +523,48 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
             self.slider_label.setText('%.1f' % slider_value)
         
         if self.live_preview:
-            blend = slider_value / 100.0
-            tween.interpolate(blend=blend, mode=self.interpolation_mode)
+            self.pending_value = slider_value
+    
+    def preview_tick(self):
+        """
+        Previews the latest slider value and records how long interpolation and refresh took.
+        """
+        if self.ticking or self.pending_value is None or not self.dragging:
+            return
+        
+        self.ticking = True
+        try:
+            blend = self.pending_value / 100.0
+            self.pending_value = None
+            
+            start_time = time.time()
+            self.preview_writer.interpolate(blend=blend, mode=self.interpolation_mode)
+            interpolate_time = time.time()
+            utils.refresh_views(self.views)
+            end_time = time.time()
             
-            view = omui2.M3dView()
-            view = view.active3dView()
-            view.refresh()
+            self.stats.add(interpolate_time - start_time, end_time - interpolate_time)
             
-        QApplication.processEvents()
-        self.busy = False
+            interval = int(self.stats.average_total() * 1000.0)
+            self.preview_timer.setInterval(min(max(interval, PREVIEW_MIN_INTERVAL), PREVIEW_MAX_INTERVAL))
+            
+            if end_time - self.stats_time > PREVIEW_STATS_INTERVAL:
+                self.stats_time = end_time
+                self.stats_label.setText(self.stats.text())
+        finally:
+            self.ticking = False
     
     def slider_released(self):
+        # the command below applies the final value, so a pending preview is stale
+        self.preview_timer.stop()
+        self.pending_value = None
         self.dragging = False
+        self.cancel_filter.remove()
+        
+        if self.cancelled:
+            self.slider.setValue(0)
+            return
+        
         slider_value = self.slider.value() / 100.0
         
         blend = slider_value / 100.0
@@ -451,7 +579,23 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
         self.slider.setValue(0)
         self.slider_label.setText('')
         
-        om.MEventMessage.removeCallback(self.idle_callback)
+        if self.stats.count > 0:
+            self.stats_label.setText(self.stats.text())
+    
+    def cancel_gesture(self):
+        """
+        Cancels the slider gesture, restoring the keys as they were before the press.
+        """
+        self.preview_timer.stop()
+        self.pending_value = None
+        self.dragging = False
+        self.cancelled = True
+        
+        if self.live_preview:
+            tween.cancel()
+            utils.refresh_views(self.views)
+        
+        self.slider_label.setText('')
     
     def fraction_clicked(self, value):
         value = value * 2.0 - 1.0
@@ -500,11 +644,28 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
             v_t = options.load_toolbar()
             v_p = options.load_presets()
             v_tds = options.load_tick_draw_special()
+            v_kps = options.load_keyhammer_preserve_shape()
             self.toolbar_widget.setVisible(v_t)
             self.toolbar_action.setChecked(v_t)
             self.preset_widget.setVisible(v_p)
             self.preset_action.setChecked(v_p)
             self.tick_draw_special_action.setChecked(v_tds)
+            self.keyhammer_preserve_shape_action.setChecked(v_kps)
+            
+            v_kls = options.load_keyhammer_layer_scope()
+            if v_kls in self.keyhammer_layer_actions:
+                self.keyhammer_layer_actions[v_kls].setChecked(True)
+        except Exception as e:
+            sys.stdout.write('# %s\n' % e)
+        
+        # live preview refresh policy
+        try:
+            v_rp = options.load_refresh_policy()
+            if v_rp in self.refresh_policy_actions:
+                self.refresh_policy_actions[v_rp].setChecked(True)
+            
+            self.preview_lod_action.setChecked(options.load_preview_lod())
+            self.preview_shadow_action.setChecked(options.load_preview_shadow())
         except Exception as e:
             sys.stdout.write('# %s\n' % e)
     
@@ -553,7 +714,10 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
     def keyhammer_button_clicked():
         cmds.undoInfo(openChunk=True, chunkName="keyHammer")
         try:
-            result = cmds.keyHammer()
+            # runs while Maya is idle, cancelling the progress bar removes the keys that were already added
+            result = cmds.keyHammer(preserveShape=options.load_keyhammer_preserve_shape(),
+                                    layerScope=options.load_keyhammer_layer_scope(),
+                                    background=True)
         finally:
             cmds.undoInfo(closeChunk=True)
         
@@ -566,19 +730,11 @@ class TweenerUI(MayaQWidgetDockableMixin, QDialog):
     
     @staticmethod
     def tick_draw_special_clicked():
-        cmds.undoInfo(openChunk=True, chunkName="Changing tick color cannot be undone")
-        try:
-            tween.tick_draw_special(special=True)
-        finally:
-            cmds.undoInfo(closeChunk=True)
+        cmds.tweener(tickDrawSpecial=True)
     
     @staticmethod
     def tick_draw_normal_clicked():
-        cmds.undoInfo(openChunk=True, chunkName="Changing tick color cannot be undone")
-        try:
-            tween.tick_draw_special(special=False)
-        finally:
-            cmds.undoInfo(closeChunk=True)
+        cmds.tweener(tickDrawSpecial=False)
     
     def live_preview_clicked(self):
         checked = self.live_preview_btn.isChecked()
@@ -667,8 +823,7 @@ class Button(QPushButton):
                 self.setFixedSize(apply_dpi_scaling(40), apply_dpi_scaling(20))
             
             self.setContentsMargins(0, 0, 0, 0)
-            path = g.plugin_path + '/' + icon
-            qicon = QIcon(path)
+            qicon = get_icon(icon)
             self.setIconSize(QSize(apply_dpi_scaling(20),
                                    apply_dpi_scaling(
                                        20)))  # icons are designed to fit 16x16 but with 2px padding
@@ -715,14 +870,37 @@ class PresetButton(QPushButton):
         # draw the normal button
         super(PresetButton, self).paintEvent(event)
         
-        # init painter
+        # draw the cached fraction graphic
         painter = QPainter(self)
-        painter.begin(self)
-        painter.setRenderHint(QPainter.Antialiasing)
         
         x = (self.geometry().width() - (
                 self.padding_x * 2 + self.pie_rect_size)) / 2
-        painter.translate(x, 0)
+        painter.drawPixmap(int(x), 0, self.get_pixmap())
+        
+        painter.end()
+    
+    def get_pixmap(self):
+        """
+        Gets the fraction graphic, drawn once per fraction, size, dpi and colors.
+        
+        :rtype: QPixmap
+        """
+        ratio = self.devicePixelRatioF()
+        width = self.padding_x * 2 + self.pie_rect_size
+        height = self.height()
+        colors = (self.dark_color.rgba(), self.accent_color.rgba(), self.stroke_color.rgba())
+        key = (round(self.fraction, 4), width, height, get_dpi_scale(), ratio, colors)
+        
+        pixmap = preset_pixmap_cache.get(key)
+        if pixmap is not None:
+            return pixmap
+        
+        pixmap = QPixmap(int(width * ratio), int(height * ratio))
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(Qt.transparent)
+        
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.Antialiasing)
         
         # base area
         painter.setPen(Qt.NoPen)
@@ -742,6 +920,9 @@ class PresetButton(QPushButton):
         painter.drawEllipse(self.rect)
         
         painter.end()
+        
+        preset_pixmap_cache[key] = pixmap
+        return pixmap
     
     def set_fraction(self, fraction, tooltip=""):
         self.fraction = fraction
@@ -752,12 +933,80 @@ class PresetButton(QPushButton):
         self.update()
 
 
+class PreviewStats(object):
+    """
+    Rolling averages of the live preview interpolation and refresh times.
+    """
+    
+    def __init__(self, size=PREVIEW_STATS_SIZE):
+        self.interpolate_times = deque(maxlen=size)
+        self.refresh_times = deque(maxlen=size)
+    
+    @property
+    def count(self):
+        return len(self.interpolate_times)
+    
+    def reset(self):
+        self.interpolate_times.clear()
+        self.refresh_times.clear()
+    
+    def add(self, interpolate_time, refresh_time):
+        self.interpolate_times.append(interpolate_time)
+        self.refresh_times.append(refresh_time)
+    
+    def average_total(self):
+        if not self.interpolate_times:
+            return 0.0
+        
+        return (sum(self.interpolate_times) + sum(self.refresh_times)) / len(self.interpolate_times)
+    
+    def text(self):
+        if not self.interpolate_times:
+            return ''
+        
+        count = float(len(self.interpolate_times))
+        return '%.1f | %.1f ms' % (sum(self.interpolate_times) / count * 1000.0,
+                                   sum(self.refresh_times) / count * 1000.0)
+
+
+def get_icon(icon):
+    """
+    Gets an icon relative to the plug-in folder, loaded once per session.
+    
+    :param icon: Relative path, e.g. 'icons/between.svg'
+    :type icon: str
+    :rtype: QIcon
+    """
+    qicon = icon_cache.get(icon)
+    if qicon is None:
+        qicon = QIcon(g.plugin_path + '/' + icon)
+        
+        # without the plug-in path the icon is not found, so try again next time
+        if g.plugin_path:
+            icon_cache[icon] = qicon
+    
+    return qicon
+
+
+def get_dpi_scale():
+    """
+    Gets Maya's dpi scale, queried once per session.
+    
+    :rtype: float
+    """
+    global dpi_scale
+    
+    if dpi_scale is None:
+        if hasattr(cmds, 'mayaDpiSetting'):
+            dpi_scale = cmds.mayaDpiSetting(q=True, realScaleValue=True)
+        else:
+            dpi_scale = 1.0
+    
+    return dpi_scale
+
+
 def apply_dpi_scaling(value, asfloat=False):
-    if hasattr(cmds, 'mayaDpiSetting'):
-        scale = cmds.mayaDpiSetting(q=True, realScaleValue=True)
-        result = scale * value
-    else:
-        result = value
+    result = get_dpi_scale() * value
     
     if asfloat:
         return result
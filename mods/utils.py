@@ -8,9 +8,15 @@ import sys
 
 import maya.api.OpenMaya as om
 import maya.api.OpenMayaAnim as oma
+import maya.api.OpenMayaUI as omui2
+import maya.OpenMayaUI as omui
 import maya.cmds as cmds
 import maya.mel as mel
 
+from PySide2.QtCore import QEvent, QObject
+from PySide2.QtWidgets import QWidget
+from shiboken2 import wrapInstance
+
 if sys.version_info >= (3, 0):
     import mods.animlayers as animlayers
 else:
@@ -31,6 +37,41 @@ ANIM_CURVE_SELECTION_ITEMS = [om.MItSelectionList.kDagSelectionItem,
                               om.MItSelectionList.kAnimSelectionItem,
                               om.MItSelectionList.kDNselectionItem]
 
+# events that may change which editors are visible, they mark the panel cache dirty
+PANEL_EVENTS = ['workspaceChanged',
+                'ActiveViewChanged',
+                'modelEditorChanged',
+                'graphEditorChanged',
+                'graphEditorParamCurveSelected',
+                'graphEditorOutlinerListChanged',
+                'NewSceneOpened',
+                'SceneOpened']
+
+# qt events on panel widgets that may change their visibility, also sent when the holding control is hidden
+PANEL_WIDGET_EVENTS = [QEvent.Show,
+                       QEvent.Hide,
+                       QEvent.ParentChange]
+
+# events that may change the attributes selected in the channel box
+CHANNELBOX_EVENTS = ['ChannelBoxLabelSelected',
+                     'SelectionChanged',
+                     'NewSceneOpened',
+                     'SceneOpened']
+
+# collects the selected attributes of all channel box sections in one evaluation
+CHANNELBOX_QUERY = ('stringArrayCatenate('
+                    'stringArrayCatenate(`channelBox -q -selectedMainAttributes mainChannelBox`, '
+                    '`channelBox -q -selectedShapeAttributes mainChannelBox`), '
+                    'stringArrayCatenate(`channelBox -q -selectedHistoryAttributes mainChannelBox`, '
+                    '`channelBox -q -selectedOutputAttributes mainChannelBox`))')
+
+# which views live preview redraws on each tick
+REFRESH_ACTIVE = 'active'  # the active 3d view
+REFRESH_VISIBLE = 'visible'  # all visible 3d views
+REFRESH_AFFECTED = 'affected'  # visible 3d views that show the animated objects
+REFRESH_ALL = 'all'  # every panel, including the graph editor
+REFRESH_POLICIES = [REFRESH_ACTIVE, REFRESH_VISIBLE, REFRESH_AFFECTED, REFRESH_ALL]
+
 
 def maya_useNewAPI():
     pass
@@ -38,13 +79,14 @@ def maya_useNewAPI():
 
 def get_selected_objects():
     """
-    Gets the active selection filtered by MFn.kDependencyNode.
+    Gets the active selection filtered by MFn.kDependencyNode. Nodes are deduplicated by their handle hash code.
     
-    :return: List of selected objects' dependencyNode
-    :rtype: list of maya.api.OpenMaya.MFnDependencyNode
+    :return: List of selected objects
+    :rtype: list of maya.api.OpenMaya.MObject
     """
     
     nodes = []
+    visited = set()
     sl_list = om.MGlobal.getActiveSelectionList()
     sl_filter = om.MFn.kDependencyNode
     it = om.MItSelectionList(sl_list, sl_filter)
@@ -52,33 +94,41 @@ def get_selected_objects():
     while not it.isDone():
         item = it.itemType()
         if item in OBJECT_SELECTION_ITEMS:
-            nodes.append(om.MFnDependencyNode(it.getDependNode()))
+            obj = it.getDependNode()
+            key = om.MObjectHandle(obj).hashCode()
+            if key not in visited:
+                visited.add(key)
+                nodes.append(obj)
         
         it.next()
     
     return nodes
 
 
-def get_anim_curves_from_objects(nodes):
+def get_anim_curves_from_objects(nodes, resolve_layers=True, use_channelbox=True):
     """ Gets the animation curves connected to nodes.
     
-    :param nodes: List with MFnDependencyNode
-    :type nodes: list of maya.api.OpenMaya.MFnDependencyNode
+    :param nodes: List of node objects
+    :type nodes: list of maya.api.OpenMaya.MObject
+    :param resolve_layers: Find the curve on the best animation layer for layered attributes
+    :type resolve_layers: bool
+    :param use_channelbox: Only include attributes selected in the channel box, if any
+    :type use_channelbox: bool
     :return: Tuple of curves and plugs
-    :rtype: (list of maya.api.OpenMaya.MFnDependencyNode, list of maya.api.OpenMaya.MPlug)
+    :rtype: (list of maya.api.OpenMaya.MObject, list of maya.api.OpenMaya.MPlug)
     """
     
     curves = []
     plugs = []
-    channelbox_attr = get_channelbox_attributes()
+    channelbox_attr = get_channelbox_attributes() if use_channelbox else None
     
     animlayers.cache.reset()  # always reset cache before querying for animation layers!
-    has_anim_layers = animlayers.has_anim_layers()
+    has_anim_layers = resolve_layers and animlayers.has_anim_layers()
     
     if has_anim_layers and animlayers.all_layers_locked():
         cmds.warning('All animation layers are locked!')
         
-    def process_plug(attr, plug, isBlendShape=False):
+    def process_plug(plug, is_filtered=False):
         if plug.isLocked or not plug.isKeyable:
             return None
         
@@ -91,30 +141,18 @@ def get_anim_curves_from_objects(nodes):
             api = conn_node.apiType()
             if api in ANIM_CURVE_TYPES:
                 # filter out attributes not selected in channelbox
-                if channelbox_attr:
-                    if isBlendShape:
-                        attr_name = plug.partialName(useAlias=True)
-                    else:
-                        attr_name = om.MFnAttribute(attr).shortName
-                        
-                    if attr_name not in channelbox_attr:
-                        return None
+                if channelbox_attr and not is_filtered and not channelbox_cache.contains(plug):
+                    return None
             
                 # add the node if it matches one of the types we want
-                curves.append(om.MFnDependencyNode(conn_node))
+                curves.append(conn_node)
                 plugs.append(plug)
         
             # find curve in animation layer
             elif has_anim_layers and api in animlayers.BLEND_NODE_TYPES:
                 # filter out attributes not selected in channelbox
-                if channelbox_attr:
-                    if isBlendShape:
-                        attr_name = plug.partialName(useAlias=True)
-                    else:
-                        attr_name = om.MFnAttribute(attr).shortName
-                        
-                    if attr_name not in channelbox_attr:
-                        return None
+                if channelbox_attr and not is_filtered and not channelbox_cache.contains(plug):
+                    return None
             
                 best_layer = animlayers.get_best_layer(plug)
                 if not best_layer:
@@ -128,25 +166,148 @@ def get_anim_curves_from_objects(nodes):
             
                 curve_node = animlayers.get_anim_curve(plug, best_layer)
                 if curve_node:
-                    curves.append(om.MFnDependencyNode(curve_node))
+                    curves.append(curve_node)
                     plugs.append(plug)
     
-    # get curves
-    for node in nodes:
-        # if blendshape
-        if node.object().apiType() == om.MFn.kBlendShape:
+    # get curves, reusing a single function set for all nodes
+    node = om.MFnDependencyNode()
+    for obj in nodes:
+        node.setObject(obj)
+        
+        if channelbox_attr:
+            channelbox_cache.resolve(node)
+        
+        # if blendshape, only look at the connected weights and the envelope
+        if obj.apiType() == om.MFn.kBlendShape:
+            aliases = channelbox_cache.blend_shape_aliases(node) if channelbox_attr else None
+            
             plug = node.findPlug('weight', True)
-            if plug.isArray:
-                for i in plug.getExistingArrayAttributeIndices():
-                    weight_plug = plug.elementByLogicalIndex(i)
-                    process_plug(attr=weight_plug.attribute(), plug=weight_plug, isBlendShape=True)
+            for i in range(plug.numConnectedElements()):
+                weight_plug = plug.connectionByPhysicalIndex(i)
+                
+                # filter out weights not selected in channelbox
+                if aliases is not None:
+                    index = weight_plug.logicalIndex()
+                    if aliases.get(index, 'weight[%d]' % index) not in channelbox_attr:
+                        continue
+                
+                process_plug(plug=weight_plug, is_filtered=True)
+            
+            plug = node.findPlug('envelope', True)
+            process_plug(plug=plug)
+            continue
         
         # get all attributes
         attr_count = node.attributeCount()
         for index in range(attr_count):
-            attr = node.attribute(index)
-            plug = node.findPlug(attr, True)
-            process_plug(attr=attr, plug=plug)
+            plug = node.findPlug(node.attribute(index), True)
+            process_plug(plug=plug)
+    
+    return curves, plugs
+
+
+def get_unlayered_anim_curves(nodes, use_channelbox=True):
+    """
+    Gets the animation curves connected directly to the nodes, which are the curves that are not on an animation layer.
+    
+    Only the connected plugs of each node are visited, instead of every attribute.
+    
+    :param nodes: List of node objects
+    :type nodes: list of maya.api.OpenMaya.MObject
+    :param use_channelbox: Only include attributes selected in the channel box, if any
+    :type use_channelbox: bool
+    :return: Tuple of curves and plugs
+    :rtype: (list of maya.api.OpenMaya.MObject, list of maya.api.OpenMaya.MPlug)
+    """
+    
+    curves = []
+    plugs = []
+    channelbox_attr = get_channelbox_attributes() if use_channelbox else None
+    
+    node = om.MFnDependencyNode()
+    for obj in nodes:
+        node.setObject(obj)
+        
+        if channelbox_attr:
+            channelbox_cache.resolve(node)
+        
+        for plug in node.getConnections():
+            if not plug.isDestination or plug.isLocked or not plug.isKeyable:
+                continue
+            
+            curve = plug.source().node()
+            if curve.apiType() not in ANIM_CURVE_TYPES:
+                continue
+            
+            # filter out attributes not selected in channelbox, blendShape weights are resolved through their aliases
+            if channelbox_attr and not channelbox_cache.contains(plug):
+                continue
+            
+            curves.append(curve)
+            plugs.append(plug)
+    
+    return curves, plugs
+
+
+def get_layered_anim_curves(nodes, layers, use_channelbox=True):
+    """
+    Gets the animation curves on the given animation layers that animate the nodes.
+    
+    Curves are looked up in the animation layer curve index, so only the given layers are visited instead of walking
+    the graph from every attribute.
+    
+    :param nodes: List of node objects
+    :type nodes: list of maya.api.OpenMaya.MObject
+    :param layers: Animation layers
+    :type layers: list of maya.api.OpenMaya.MObject
+    :param use_channelbox: Only include attributes selected in the channel box, if any
+    :type use_channelbox: bool
+    :return: Tuple of curves and plugs
+    :rtype: (list of maya.api.OpenMaya.MObject, list of maya.api.OpenMaya.MPlug)
+    """
+    
+    curves = []
+    plugs = []
+    
+    if not nodes or not layers:
+        return curves, plugs
+    
+    channelbox_attr = get_channelbox_attributes() if use_channelbox else None
+    node_keys = set(om.MObjectHandle(node).hashCode() for node in nodes)
+    visited = set()
+    
+    curve_fn = om.MFnDependencyNode()
+    node_fn = om.MFnDependencyNode()
+    
+    for layer in layers:
+        for curve in animlayers.curve_index.get_curves(layer):
+            if curve.apiType() not in ANIM_CURVE_TYPES:
+                continue
+            
+            curve_key = om.MObjectHandle(curve).hashCode()
+            if curve_key in visited:
+                continue
+            
+            visited.add(curve_key)
+            
+            curve_fn.setObject(curve)
+            plug = default_cache.anim_curve_target_plug(curve_fn)
+            if plug is None or plug.isLocked or not plug.isKeyable:
+                continue
+            
+            node = plug.node()
+            if om.MObjectHandle(node).hashCode() not in node_keys:
+                continue
+            
+            # filter out attributes not selected in channelbox
+            if channelbox_attr:
+                node_fn.setObject(node)
+                channelbox_cache.resolve(node_fn)
+                if not channelbox_cache.contains(plug):
+                    continue
+            
+            curves.append(curve)
+            plugs.append(plug)
     
     return curves, plugs
 
@@ -158,37 +319,97 @@ def get_selected_anim_curves():
     We only want to modify the following animCurve types: TL, TA, TU, TT
     - UL, UA, UU, UT are used for set driven keys
     
-    :return: Dictionary with curve names as key and node as value
-    :rtype: list of maya.api.OpenMaya.MFnDependencyNode
+    :return: List of curve objects, deduplicated by their handle hash code
+    :rtype: list of maya.api.OpenMaya.MObject
     """
     
     sl_list = om.MGlobal.getActiveSelectionList()
     it = om.MItSelectionList(sl_list, om.MFn.kAnimCurve)
     
-    curve_dict = {}
+    curves = []
+    visited = set()
     
     while not it.isDone():
         if it.itemType() in ANIM_CURVE_SELECTION_ITEMS:
             obj = it.getDependNode()
             if obj.apiType() in ANIM_CURVE_TYPES:
-                # add node to dict using absolute name to avoid duplicates - which happens when curves are selected
-                node = om.MFnDependencyNode(obj)
-                curve_dict[node.absoluteName()] = node
+                # use the handle hash to avoid duplicates - which happens when curves are selected
+                key = om.MObjectHandle(obj).hashCode()
+                if key not in visited:
+                    visited.add(key)
+                    curves.append(obj)
         
         it.next()
     
-    return curve_dict.values()
+    return curves
+
+
+def get_anim_curves_from_names(names):
+    """
+    Get animation curves from a list of names, without looking at the selection or the UI.
+    
+    Names of animation curves are used directly, other nodes are expanded to the animation curves of all their
+    attributes, ignoring the channel box.
+    
+    :param names: Names of animation curves or animated nodes
+    :type names: list of str
+    :return: List of curve objects, deduplicated by their handle hash code
+    :rtype: list of maya.api.OpenMaya.MObject
+    """
+    
+    sel = om.MSelectionList()
+    for name in names:
+        try:
+            sel.add(name)
+        except RuntimeError:
+            raise ValueError('No object matches name: %s' % name)
+    
+    curves = []
+    nodes = []
+    visited = set()
+    
+    for i in range(sel.length()):
+        obj = sel.getDependNode(i)
+        if obj.hasFn(om.MFn.kAnimCurve):
+            if obj.apiType() in ANIM_CURVE_TYPES:
+                curves.append(obj)
+        else:
+            nodes.append(obj)
+    
+    if nodes:
+        curves.extend(get_anim_curves_from_objects(nodes, use_channelbox=False)[0])
+    
+    result = []
+    for obj in curves:
+        key = om.MObjectHandle(obj).hashCode()
+        if key not in visited:
+            visited.add(key)
+            result.append(obj)
+    
+    return result
 
 
 def get_attribute_default_value(plug):
     """ Get the default value for the given plug
     
+    Default values only depend on the attribute, so they are looked up in the default value cache first.
+    
     :param plug: Plug for the attribute
     :type plug: maya.api.OpenMaya.MPlug
     :return: Default value of the attribute found on the plug
     :rtype: float or None
     """
-    attr = plug.attribute()
+    return default_cache.attribute_default_value(plug.attribute())
+
+
+def find_attribute_default_value(attr):
+    """ Get the default value of the given attribute, without using the cache
+    
+    :param attr: Attribute object
+    :type attr: maya.api.OpenMaya.MObject
+    :return: Default value of the attribute
+    :rtype: float or None
+    """
     api = attr.apiType()
     
     if api == om.MFn.kNumericAttribute:
@@ -218,6 +439,24 @@ def get_anim_curve_default_value(anim_curve):
     :rtype: float or None
     """
     
+    target_plug = default_cache.anim_curve_target_plug(anim_curve)
+    
+    if target_plug is None:
+        return None
+    
+    return get_attribute_default_value(target_plug)
+
+
+def find_anim_curve_target_plug(anim_curve):
+    """
+    Get the plug of the attribute the given anim curve animates, searching through animation layer blend nodes.
+    
+    :param anim_curve: Animation curve
+    :type anim_curve: maya.api.OpenMayaAnim.MFnAnimCurve
+    :return: Plug of the animated attribute
+    :rtype: maya.api.OpenMaya.MPlug or None
+    """
+    
     plug = anim_curve.findPlug('output', True)
     
     if plug:
@@ -229,7 +468,7 @@ def get_anim_curve_default_value(anim_curve):
         for dst_plug in destinations:
             # if the first node we hit does not have an output, assume it is the node we want to animate
             if dst_plug.node().hasFn(om.MFn.kDagNode):
-                return get_attribute_default_value(dst_plug)
+                return dst_plug
             
             it = om.MItDependencyGraph(dst_plug, om.MFn.kInvalid,
                                        direction=om.MItDependencyGraph.kDownstream,
@@ -249,6 +488,9 @@ def get_anim_curve_default_value(anim_curve):
                 
                 it.next()
             
+            if target_plug is None:
+                continue
+            
             # if plug is compound then use same child index as the one we came from
             if dst_plug.isChild and target_plug.isChild:
                 parent = dst_plug.parent()
@@ -260,46 +502,522 @@ def get_anim_curve_default_value(anim_curve):
                 
                 target_parent = target_plug.parent()
                 if target_parent.numChildren() > idx:
-                    p = target_parent.child(idx)
-                    return get_attribute_default_value(p)
+                    return target_parent.child(idx)
                 else:
                     return None
             
             # resolve non-compound plugs
-            if target_plug:
-                return get_attribute_default_value(target_plug)
+            return target_plug
     
     return None
 
 
+def add_graph_callbacks(connection_callback, scene_callback):
+    """
+    Registers the callbacks used by caches that depend on connections: one for connection changes and one for each
+    new or opened scene.
+    
+    :param connection_callback: Called when a connection is made or broken
+    :type connection_callback: function
+    :param scene_callback: Called after a new scene is created or a scene is opened
+    :type scene_callback: function
+    :return: Callback ids
+    :rtype: list of int
+    """
+    return [om.MDGMessage.addConnectionCallback(connection_callback),
+            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterNew, scene_callback),
+            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterOpen, scene_callback)]
+
+
+def remove_callback_ids(callback_ids):
+    """
+    Removes the callbacks, ignoring the ones that are already gone.
+    
+    :param callback_ids: Callback ids
+    :type callback_ids: list of int
+    """
+    for callback_id in callback_ids:
+        try:
+            om.MMessage.removeCallback(callback_id)
+        except Exception:
+            pass
+
+
+class DefaultValueCache(object):
+    """
+    Memoizes attribute default values, the attribute plug each anim curve drives and the dag nodes it affects.
+    
+    Default values are keyed on the attribute object, which is shared by all nodes of the same type. The curve to plug
+    and curve to dag node maps are cleared whenever connections change or a scene is opened.
+    """
+    
+    def __init__(self):
+        self.__attribute_values = {}
+        self.__curve_plugs = {}
+        self.__curve_nodes = {}
+        self.__callback_ids = []
+    
+    def reset(self, *args):
+        """
+        Clears all caches. Also used as callback, hence *args.
+        """
+        self.__attribute_values = {}
+        self.__curve_plugs = {}
+        self.__curve_nodes = {}
+    
+    def reset_curve_plugs(self, *args):
+        """
+        Clears the curve to plug and curve to dag node maps. Also used as callback, hence *args.
+        """
+        self.__curve_plugs = {}
+        self.__curve_nodes = {}
+    
+    def add_callbacks(self):
+        """
+        Registers the callbacks that invalidate the cache.
+        """
+        self.remove_callbacks()
+        
+        self.__callback_ids = add_graph_callbacks(self.reset_curve_plugs, self.reset)
+        self.reset()
+    
+    def remove_callbacks(self):
+        """
+        Removes all callbacks registered by the cache.
+        """
+        remove_callback_ids(self.__callback_ids)
+        
+        self.__callback_ids = []
+        self.reset()
+    
+    def attribute_default_value(self, attr):
+        """
+        Get the default value of the attribute, resolving it only once per attribute.
+        
+        :param attr: Attribute object
+        :type attr: maya.api.OpenMaya.MObject
+        :return: Default value of the attribute
+        :rtype: float or None
+        """
+        handle = om.MObjectHandle(attr)
+        key = handle.hashCode()
+        
+        cached = self.__attribute_values.get(key)
+        if cached is not None and cached[0].isValid() and cached[0].object() == attr:
+            return cached[1]
+        
+        value = find_attribute_default_value(attr)
+        self.__attribute_values[key] = (handle, value)
+        
+        return value
+    
+    def anim_curve_target_plug(self, anim_curve):
+        """
+        Get the plug the anim curve animates, only traversing the graph if the curve is not in the cache.
+        
+        :param anim_curve: Animation curve
+        :type anim_curve: maya.api.OpenMayaAnim.MFnAnimCurve
+        :return: Plug of the animated attribute
+        :rtype: maya.api.OpenMaya.MPlug or None
+        """
+        handle = om.MObjectHandle(anim_curve.object())
+        key = handle.hashCode()
+        
+        cached = self.__curve_plugs.get(key)
+        if cached is not None and cached[0].isValid() and cached[0].object() == anim_curve.object():
+            return cached[1]
+        
+        target_plug = find_anim_curve_target_plug(anim_curve)
+        
+        # without callbacks the connections could change unnoticed, so only store when they are registered
+        if self.__callback_ids:
+            self.__curve_plugs[key] = (handle, target_plug)
+        
+        return target_plug
+    
+    def anim_curve_dag_nodes(self, anim_curve):
+        """
+        Get the dag nodes the anim curve drives, only resolving them if the curve is not in the cache.
+        
+        :param anim_curve: Animation curve
+        :type anim_curve: maya.api.OpenMayaAnim.MFnAnimCurve
+        :return: Dag nodes
+        :rtype: list of maya.api.OpenMaya.MObject
+        """
+        handle = om.MObjectHandle(anim_curve.object())
+        key = handle.hashCode()
+        
+        cached = self.__curve_nodes.get(key)
+        if cached is not None and cached[0].isValid() and cached[0].object() == anim_curve.object():
+            return cached[1]
+        
+        nodes = find_anim_curve_dag_nodes(anim_curve)
+        
+        if self.__callback_ids:
+            self.__curve_nodes[key] = (handle, nodes)
+        
+        return nodes
+
+
 def get_channelbox_attributes():
     """
-    Get the short names of attributes selected in the channel box.
+    Get the names of attributes selected in the channel box, served from the channel box cache.
     
     :return: Set of attributes short name as strings or None
     :rtype: set of string or None
     """
     
-    attr = set()
+    return channelbox_cache.names
+
+
+def find_channelbox_attributes():
+    """
+    Query the names of attributes selected in all sections of the channel box, in a single MEL evaluation.
     
-    s1 = cmds.channelBox('mainChannelBox', q=True, selectedMainAttributes=True)
-    s2 = cmds.channelBox('mainChannelBox', q=True, selectedShapeAttributes=True)
-    s3 = cmds.channelBox('mainChannelBox', q=True, selectedHistoryAttributes=True)
-    s4 = cmds.channelBox('mainChannelBox', q=True, selectedOutputAttributes=True)
+    :return: Set of attributes short name as strings or None
+    :rtype: set of string or None
+    """
     
-    if s1:
-        attr |= set(s1)
-    if s2:
-        attr |= set(s2)
-    if s3:
-        attr |= set(s3)
-    if s4:
-        attr |= set(s4)
+    attr = mel.eval(CHANNELBOX_QUERY)
     
-    if len(attr) == 0:
+    if not attr:
         return None
     
-    return attr
+    return set(attr)
+
+
+def get_blend_shape_aliases(node):
+    """
+    Get the aliases of all weights on a blendShape node, using a single aliasAttr query.
+    
+    :param node: BlendShape node
+    :type node: maya.api.OpenMaya.MFnDependencyNode
+    :return: Dictionary with weight logical index as key and alias as value
+    :rtype: dict of (int, str)
+    """
+    
+    aliases = {}
+    result = cmds.aliasAttr(node.absoluteName(), q=True)  # [alias, 'weight[0]', alias, 'weight[1]', ...]
+    
+    if not result:
+        return aliases
+    
+    for alias, attr_name in zip(result[0::2], result[1::2]):
+        if attr_name.startswith('weight[') and attr_name.endswith(']'):
+            try:
+                aliases[int(attr_name[7:-1])] = alias
+            except ValueError:
+                pass
+    
+    return aliases
+
+
+def get_plug_key(plug):
+    """
+    Get a hashable key for the plug's node and attribute. Array elements also include their logical index.
+    
+    The node is part of the key, because an alias like a blendShape target name only resolves to an element on the
+    node it belongs to.
+    
+    :param plug: Attribute plug
+    :type plug: maya.api.OpenMaya.MPlug
+    :return: Plug key
+    :rtype: (int, int, int)
+    """
+    
+    node_key = om.MObjectHandle(plug.node()).hashCode()
+    attr_key = om.MObjectHandle(plug.attribute()).hashCode()
+    
+    return node_key, attr_key, plug.logicalIndex() if plug.isElement else -1
+
+
+class ChannelBoxCache(object):
+    """
+    Stores the attributes selected in the channel box, until the channel box or the object selection changes.
+    
+    Besides the names, the cache holds a set of plug keys (see get_plug_key) that is filled per node, so plugs can
+    be filtered without comparing names. Without registered callbacks the cache is reset on every use.
+    """
+    
+    def __init__(self):
+        self.__names = None
+        self.__dirty = True
+        self.__keys = set()
+        self.__resolved_nodes = set()
+        self.__aliases = {}
+        self.__callback_ids = []
+    
+    def reset(self, *args):
+        """
+        Marks the cache dirty. Also used as callback, hence *args.
+        """
+        self.__names = None
+        self.__dirty = True
+        self.__keys = set()
+        self.__resolved_nodes = set()
+        self.__aliases = {}
+    
+    def add_callbacks(self):
+        """
+        Registers the callbacks that mark the cache dirty.
+        """
+        self.remove_callbacks()
+        
+        for event in CHANNELBOX_EVENTS:
+            try:
+                self.__callback_ids.append(om.MEventMessage.addEventCallback(event, self.reset))
+            except Exception as e:
+                sys.stdout.write('# Could not track event %s: %s\n' % (event, e))
+    
+    def remove_callbacks(self):
+        """
+        Removes all callbacks registered by the cache.
+        """
+        for callback_id in self.__callback_ids:
+            try:
+                om.MMessage.removeCallback(callback_id)
+            except Exception:
+                pass
+        
+        self.__callback_ids = []
+        self.reset()
+    
+    @property
+    def names(self):
+        """
+        Get the names of the selected channel box attributes, only querying the channel box when dirty.
+        
+        :return: Set of attribute names or None
+        :rtype: set of string or None
+        """
+        if self.__dirty or not self.__callback_ids:
+            self.reset()
+            self.__names = find_channelbox_attributes()
+            self.__dirty = False
+        
+        return self.__names
+    
+    def resolve(self, node):
+        """
+        Adds the keys of the node's attributes matching the selected names to the filter. Each node is only resolved
+        once while the cache is valid. The names must be read first.
+        
+        :param node: Dependency node
+        :type node: maya.api.OpenMaya.MFnDependencyNode
+        """
+        names = self.__names
+        if not names:
+            return
+        
+        node_key = om.MObjectHandle(node.object()).hashCode()
+        if node_key in self.__resolved_nodes:
+            return
+        
+        self.__resolved_nodes.add(node_key)
+        
+        for name in names:
+            try:
+                plug = node.findPlug(name, True)  # also resolves aliases, e.g. blendShape weights
+            except Exception:
+                continue  # the attribute belongs to another node
+            
+            self.__keys.add(get_plug_key(plug))
+    
+    def blend_shape_aliases(self, node):
+        """
+        Get the weight aliases of a blendShape node. The aliases are kept until the channel box or selection changes,
+        which also happens when targets are renamed.
+        
+        :param node: BlendShape node
+        :type node: maya.api.OpenMaya.MFnDependencyNode
+        :return: Dictionary with weight logical index as key and alias as value
+        :rtype: dict of (int, str)
+        """
+        node_key = om.MObjectHandle(node.object()).hashCode()
+        
+        aliases = self.__aliases.get(node_key)
+        if aliases is None:
+            aliases = get_blend_shape_aliases(node)
+            self.__aliases[node_key] = aliases
+        
+        return aliases
+    
+    def contains(self, plug):
+        """
+        Get whether the plug's attribute is selected in the channel box. The plug's node must be resolved first.
+        
+        :param plug: Attribute plug
+        :type plug: maya.api.OpenMaya.MPlug
+        :rtype: bool
+        """
+        return get_plug_key(plug) in self.__keys
+
+
+class PanelWatcher(QObject):
+    """
+    Event filter for panel widgets, which calls back when a panel is shown, hidden or moved to another parent.
+    
+    Qt also sends these events when the workspace control holding the panel is closed, collapsed or minimized, so
+    Maya's own commands on the control are left alone.
+    """
+    
+    def __init__(self, callback):
+        """
+        :param callback: Called without arguments when a watched panel changes
+        :type callback: function
+        """
+        super(PanelWatcher, self).__init__()
+        self.callback = callback
+    
+    def eventFilter(self, obj, event):
+        if event.type() in PANEL_WIDGET_EVENTS:
+            self.callback()
+        
+        return False
+
+
+class PanelCache(object):
+    """
+    Stores the visibility of panel types, so Maya's UI does not have to be queried on every gesture.
+    
+    The panel list of each type is cached until a workspace or editor change event, or until a panel is deleted.
+    Visibility is cached until one of those, or until Qt reports that a panel widget was shown, hidden or reparented.
+    Panels that have no widget yet cannot be watched, so their type is only cached once they have been opened.
+    Without registered callbacks the cache is bypassed.
+    """
+    
+    def __init__(self):
+        self.__visible = {}
+        self.__panels = {}
+        self.__callback_ids = []
+        self.__watched = {}
+        self.__watcher = None
+    
+    def reset(self, *args):
+        """
+        Marks all panel types and panel lists as dirty. Also used as callback, hence *args.
+        """
+        self.__visible = {}
+        self.__panels = {}
+    
+    def reset_visible(self, *args):
+        """
+        Marks the visibility of all panel types as dirty. Also used as callback, hence *args.
+        """
+        self.__visible = {}
+    
+    @property
+    def is_tracking(self):
+        """
+        Get whether callbacks are keeping the cache up to date.
+        
+        :rtype: bool
+        """
+        return len(self.__callback_ids) > 0
+    
+    def add_callbacks(self):
+        """
+        Registers the UI callbacks that keep the cache current.
+        """
+        self.remove_callbacks()
+        
+        for event in PANEL_EVENTS:
+            try:
+                self.__callback_ids.append(om.MEventMessage.addEventCallback(event, self.reset))
+            except Exception as e:
+                sys.stdout.write('# Could not track event %s: %s\n' % (event, e))
+        
+        self.__watcher = PanelWatcher(self.reset_visible)
+        self.reset()
+    
+    def remove_callbacks(self):
+        """
+        Removes all callbacks and event filters registered by the cache.
+        """
+        callback_ids = self.__callback_ids + [callback_id for widget, callback_id in self.__watched.values()]
+        remove_callback_ids(callback_ids)
+        
+        for widget, callback_id in self.__watched.values():
+            try:
+                widget.removeEventFilter(self.__watcher)
+            except RuntimeError:
+                pass  # the widget is already gone
+        
+        self.__callback_ids = []
+        self.__watched = {}
+        self.__watcher = None
+        self.reset()
+    
+    def is_visible(self, typ):
+        """
+        Get the cached visibility of a panel type, querying Maya only if the entry is dirty.
+        
+        :param typ: Name of panel type to check
+        :type typ: str
+        :return: True if the panel is visible, otherwise False
+        :rtype: bool
+        """
+        if not self.is_tracking:
+            return is_panel_type_visible(typ)
+        
+        visible = self.__visible.get(typ)
+        if visible is not None:
+            return visible
+        
+        panels = self.__panels.get(typ)
+        if panels is None:
+            try:
+                panels = cmds.getPanel(sty=typ) or []
+            except Exception:
+                panels = []
+            
+            self.__panels[typ] = panels
+        
+        visible = is_panel_type_visible(typ)
+        
+        if self.watch_panels(panels):
+            self.__visible[typ] = visible
+        
+        return visible
+    
+    def watch_panels(self, panels):
+        """
+        Installs the event filter on the widgets of the panels and a deletion callback on the panels.
+        
+        :param panels: Panel names
+        :type panels: list of str
+        :return: True if every panel is watched
+        :rtype: bool
+        """
+        watched = True
+        
+        for panel in panels:
+            if panel in self.__watched:
+                continue
+            
+            ptr = omui.MQtUtil.findControl(panel)
+            if not ptr:
+                watched = False  # not opened yet
+                continue
+            
+            try:
+                callback_id = omui2.MUiMessage.addUiDeletedCallback(panel, self.panel_deleted, panel)
+            except Exception:
+                watched = False
+                continue
+            
+            widget = wrapInstance(int(ptr), QWidget)
+            widget.installEventFilter(self.__watcher)
+            self.__watched[panel] = (widget, callback_id)
+        
+        return watched
+    
+    def panel_deleted(self, panel=None):
+        """
+        Callback for when a watched panel is deleted.
+        """
+        self.__watched.pop(panel, None)
+        self.reset()
 
 
 def is_graph_editor_or_dope_sheet():
@@ -318,11 +1036,11 @@ def is_graph_editor_or_dope_sheet():
         return False
 
     # we have keys, so check if graph editor is visible
-    if is_panel_type_visible('graphEditor'):
+    if panel_cache.is_visible('graphEditor'):
         return True
     
     # ... or dope sheet
-    if is_panel_type_visible('dopeSheetPanel'):
+    if panel_cache.is_visible('dopeSheetPanel'):
         return True
     
     return False
@@ -398,6 +1116,169 @@ def get_curve_tangents_bezier_points(curve_fn, start_index, end_index):
     return p1, p2, p3, p4
 
 
+def get_views_to_refresh(policy, curves=None):
+    """
+    Gets the views to redraw during a gesture. Meant to be called once per gesture, as the affected policy projects
+    the bounding boxes of the animated objects into every visible view.
+    
+    :param policy: One of REFRESH_POLICIES
+    :type policy: str
+    :param curves: Animation curves being changed, used by the affected policy
+    :type curves: list of maya.api.OpenMayaAnim.MFnAnimCurve or None
+    :return: Views to refresh, or None to refresh every panel
+    :rtype: list of maya.api.OpenMayaUI.M3dView or None
+    """
+    if policy == REFRESH_ALL:
+        return None
+    
+    if policy == REFRESH_ACTIVE:
+        return [omui2.M3dView.active3dView()]
+    
+    views = get_visible_3d_views()
+    
+    if policy == REFRESH_AFFECTED:
+        paths = get_affected_dag_paths(curves or [])
+        views = [view for view in views if is_view_showing_any(view, paths)]
+    
+    # nothing found, so fall back to the view the user works in
+    if not views:
+        views = [omui2.M3dView.active3dView()]
+    
+    return views
+
+
+def refresh_views(views):
+    """
+    Redraws the given views.
+    
+    :param views: Views from get_views_to_refresh, None refreshes every panel
+    :type views: list of maya.api.OpenMayaUI.M3dView or None
+    """
+    if views is None:
+        cmds.refresh()
+        return
+    
+    for view in views:
+        view.refresh()
+
+
+def get_visible_3d_views():
+    """
+    Gets all visible 3d views.
+    
+    :rtype: list of maya.api.OpenMayaUI.M3dView
+    """
+    views = []
+    for i in range(omui2.M3dView.numberOf3dViews()):
+        view = omui2.M3dView.get3dView(i)
+        if view.isVisible():
+            views.append(view)
+    
+    return views
+
+
+def get_affected_dag_paths(curves):
+    """
+    Gets the dag nodes driven by the animation curves, resolved once per curve by the default value cache.
+    
+    :param curves: Animation curves
+    :type curves: list of maya.api.OpenMayaAnim.MFnAnimCurve
+    :rtype: list of maya.api.OpenMaya.MDagPath
+    """
+    paths = []
+    visited = set()
+    
+    for curve_fn in curves:
+        for obj in default_cache.anim_curve_dag_nodes(curve_fn):
+            key = om.MObjectHandle(obj).hashCode()
+            if key in visited:
+                continue
+            
+            visited.add(key)
+            paths.append(om.MDagPath.getAPathTo(obj))
+    
+    return paths
+
+
+def find_anim_curve_dag_nodes(anim_curve):
+    """
+    Get the dag nodes the given anim curve drives, starting from the nodes connected to its output. Animation layer
+    blend nodes are followed by the target plug lookup, pairBlends and unit conversions by their outputs and deformers
+    like blendShapes by the shapes they output to.
+    
+    :param anim_curve: Animation curve
+    :type anim_curve: maya.api.OpenMayaAnim.MFnAnimCurve
+    :return: Dag nodes
+    :rtype: list of maya.api.OpenMaya.MObject
+    """
+    nodes = []
+    pending = [dst_plug.node() for dst_plug in anim_curve.findPlug('output', True).destinations()]
+    visited = set()
+    
+    while pending:
+        obj = pending.pop()
+        
+        key = om.MObjectHandle(obj).hashCode()
+        if key in visited:
+            continue
+        
+        visited.add(key)
+        
+        if obj.hasFn(om.MFn.kDagNode):
+            nodes.append(obj)
+        
+        elif obj.apiType() in animlayers.BLEND_NODE_TYPES:
+            target_plug = default_cache.anim_curve_target_plug(anim_curve)
+            if target_plug is not None:
+                pending.append(target_plug.node())
+        
+        elif obj.hasFn(om.MFn.kGeometryFilt):
+            # follow the output geometry, which may go through more deformers before it reaches a shape
+            plug = om.MFnDependencyNode(obj).findPlug('outputGeometry', True)
+            for i in range(plug.numConnectedElements()):
+                for dst_plug in plug.connectionByPhysicalIndex(i).destinations():
+                    pending.append(dst_plug.node())
+        
+        elif obj.hasFn(om.MFn.kPairBlend) or obj.hasFn(om.MFn.kUnitConversion):
+            for plug in om.MFnDependencyNode(obj).getConnections():
+                if plug.isSource:
+                    pending.extend(dst_plug.node() for dst_plug in plug.destinations())
+    
+    return nodes
+
+
+def is_view_showing_any(view, paths):
+    """
+    Determine if the world space bounding box of any of the dag paths overlaps the view.
+    
+    :param view: 3d view
+    :type view: maya.api.OpenMayaUI.M3dView
+    :param paths: Dag paths
+    :type paths: list of maya.api.OpenMaya.MDagPath
+    :rtype: bool
+    """
+    width = view.portWidth()
+    height = view.portHeight()
+    
+    for path in paths:
+        bbox = om.MFnDagNode(path).boundingBox
+        matrix = path.inclusiveMatrix()
+        
+        xs = []
+        ys = []
+        for x in (bbox.min.x, bbox.max.x):
+            for y in (bbox.min.y, bbox.max.y):
+                for z in (bbox.min.z, bbox.max.z):
+                    view_point = view.worldToView(om.MPoint(x, y, z) * matrix)
+                    xs.append(view_point[0])
+                    ys.append(view_point[1])
+        
+        if max(xs) >= 0 and min(xs) <= width and max(ys) >= 0 and min(ys) <= height:
+            return True
+    
+    return False
+
+
 def clamp(value, min_value, max_value):
     """
     Clamp a value between min and max.
@@ -414,3 +1295,28 @@ def clamp(value, min_value, max_value):
         return max_value
     else:
         return value
+
+
+panel_cache = PanelCache()
+default_cache = DefaultValueCache()
+channelbox_cache = ChannelBoxCache()
+
+
+def add_callbacks():
+    """
+    Registers the callbacks that keep the module caches current.
+    """
+    panel_cache.add_callbacks()
+    default_cache.add_callbacks()
+    channelbox_cache.add_callbacks()
+    animlayers.curve_index.add_callbacks()
+
+
+def remove_callbacks():
+    """
+    Removes the callbacks registered by the module caches.
+    """
+    panel_cache.remove_callbacks()
+    default_cache.remove_callbacks()
+    channelbox_cache.remove_callbacks()
+    animlayers.curve_index.remove_callbacks()
@@ -269,7 +269,7 @@ def load(plugin_path):
     
     if answer == 'Yes':
         try:
-            tweener.ui.add_shelf_button(path=plugin_path)
+            tweener.load_ui().add_shelf_button(path=plugin_path)
         except Exception as e:
             logging.exception(e)
     
@@ -8,6 +8,10 @@ Please refer to the plug-ins GitHub page for more information at https://github.
 # standard modules
 import sys
 import os
+import json
+import time
+
+load_start_time = time.time()
 
 # maya modules
 import maya.api.OpenMaya as om
@@ -16,18 +20,48 @@ import maya.cmds as cmds
 
 # tweener modules
 import mods.globals as g
-import mods.ui as ui
 import mods.tween as tween
 import mods.animdata as animdata
 import mods.keyhammer as keyhammer
-import mods.tool as tool
 import mods.options as options
+import mods.utils as utils
+
+# mods.ui and mods.tool import Qt and create the tool context, so they are only imported when first used.
+# that keeps loading the plug-in cheap, e.g. in batch sessions that never show the window
+ui = None
+tool = None
 
 
 def maya_useNewAPI():
     pass
 
 
+def load_ui():
+    """
+    Imports the ui module on first use.
+    """
+    global ui
+    
+    if ui is None:
+        import mods.ui as ui_module
+        ui = ui_module
+    
+    return ui
+
+
+def load_tool():
+    """
+    Imports the tool module on first use.
+    """
+    global tool
+    
+    if tool is None:
+        import mods.tool as tool_module
+        tool = tool_module
+    
+    return tool
+
+
 def reload_mods():
     """
     For development and installation purposes only
@@ -70,6 +104,8 @@ def initializePlugin(plugin):
     Initialize plugin commands
     """
     
+    init_start_time = time.time()
+    
     plugin_fn = om.MFnPlugin(plugin,
                              "Morten Andersen",
                              g.plugin_version,
@@ -101,7 +137,8 @@ def initializePlugin(plugin):
     # register KeyHammerCmd
     try:
         plugin_fn.registerCommand(KeyHammerCmd.cmd_name,
-                                  KeyHammerCmd.cmd_creator)
+                                  KeyHammerCmd.cmd_creator,
+                                  KeyHammerCmd.syntax_creator)
     except Exception as e:
         sys.stderr.write("%s\n" % str(e))
         sys.stderr.write("Failed to register command: %s\n" % KeyHammerCmd.cmd_name)
@@ -122,6 +159,21 @@ def initializePlugin(plugin):
     
     g.plugin_path = os.path.dirname(cmds.pluginInfo(plugin_fn.name(), q=True, path=True)) + '/'
     
+    # read the preferences again, they may have been changed while the plug-in was unloaded
+    options.store.reload()
+    
+    # keep the utils caches (visible editors, default values) current through callbacks
+    try:
+        utils.add_callbacks()
+    except Exception as e:
+        sys.stderr.write("%s\n" % str(e))
+        sys.stderr.write("Failed to add callbacks.\n")
+    
+    sys.stdout.write('# Tweener loaded in %.1f ms (%.1f ms to import, %.1f ms to initialize)\n' % (
+        (time.time() - load_start_time) * 1000.0,
+        (init_start_time - load_start_time) * 1000.0,
+        (time.time() - init_start_time) * 1000.0))
+    
     # restore the window, if it exists
     try:
         if cmds.workspaceControl('tweenerUIWindowWorkspaceControl', exists=True):
@@ -139,6 +191,12 @@ def uninitializePlugin(plugin):
     
     plugin_fn = om.MFnPlugin(plugin)
     
+    # remove callbacks
+    utils.remove_callbacks()
+    
+    # write preferences that are waiting for idle
+    options.store.flush()
+    
     # deregister TweenerCmd
     try:
         plugin_fn.deregisterCommand(TweenerCmd.cmd_name)
@@ -188,6 +246,7 @@ class TweenerCmd(om.MPxCommand):
     
     cmd_name = 'tweener'
     anim_cache = None
+    tick_modifier = None
     
     # command flags
     interpolant_flag = '-t'
@@ -196,11 +255,32 @@ class TweenerCmd(om.MPxCommand):
     type_flag_long = '-type'
     new_cache_flag = '-nc'
     new_cache_long = '-newCache'
+    mode_flag = '-m'
+    mode_flag_long = '-mode'
+    curves_flag = '-c'
+    curves_flag_long = '-curves'
+    frames_flag = '-f'
+    frames_flag_long = '-frames'
+    index_flag = '-i'
+    index_flag_long = '-index'
+    stride_flag = '-st'
+    stride_flag_long = '-stride'
+    time_range_flag = '-tr'
+    time_range_flag_long = '-timeRange'
+    tick_flag = '-tds'
+    tick_flag_long = '-tickDrawSpecial'
     
     # default command argument values
     blend_arg = 0
     new_cache_arg = True
     type_arg = None
+    mode_arg = None
+    curves_arg = None
+    frames_arg = None
+    index_arg = None
+    stride_arg = None
+    time_range_arg = None
+    tick_arg = None
     
     def __init__(self):
         om.MPxCommand.__init__(self)
@@ -217,6 +297,23 @@ class TweenerCmd(om.MPxCommand):
         syntax.addFlag(cls.interpolant_flag, cls.interpolant_flag_long, om.MSyntax.kDouble)
         syntax.addFlag(cls.new_cache_flag, cls.new_cache_long, om.MSyntax.kBoolean)
         syntax.addFlag(cls.type_flag, cls.type_flag_long, om.MSyntax.kLong)
+        
+        # explicit targets, so scripts can tween without any selection or ui queries
+        syntax.addFlag(cls.mode_flag, cls.mode_flag_long, om.MSyntax.kString)
+        syntax.addFlag(cls.curves_flag, cls.curves_flag_long, om.MSyntax.kString)
+        syntax.addFlag(cls.frames_flag, cls.frames_flag_long, om.MSyntax.kDouble)
+        syntax.addFlag(cls.index_flag, cls.index_flag_long, om.MSyntax.kLong)
+        
+        # batch tween every n frames in one undo chunk
+        syntax.addFlag(cls.stride_flag, cls.stride_flag_long, om.MSyntax.kDouble)
+        syntax.addFlag(cls.time_range_flag, cls.time_range_flag_long, om.MSyntax.kDouble, om.MSyntax.kDouble)
+        
+        # undoable tick color of the selected keys
+        syntax.addFlag(cls.tick_flag, cls.tick_flag_long, om.MSyntax.kBoolean)
+        
+        syntax.makeFlagMultiUse(cls.curves_flag)
+        syntax.makeFlagMultiUse(cls.frames_flag)
+        syntax.makeFlagMultiUse(cls.index_flag)
         return syntax
     
     def pass_args(self, args):
@@ -231,32 +328,129 @@ class TweenerCmd(om.MPxCommand):
         if arg_data.isFlagSet(self.type_flag):
             self.type_arg = arg_data.flagArgumentInt(self.type_flag, 0)
         
+        if arg_data.isFlagSet(self.mode_flag):
+            self.mode_arg = arg_data.flagArgumentString(self.mode_flag, 0)
+        
+        if arg_data.isFlagSet(self.curves_flag):
+            self.curves_arg = [arg_data.getFlagArgumentList(self.curves_flag, i).asString(0)
+                               for i in range(arg_data.numberOfFlagUses(self.curves_flag))]
+        
+        if arg_data.isFlagSet(self.frames_flag):
+            self.frames_arg = [arg_data.getFlagArgumentList(self.frames_flag, i).asDouble(0)
+                               for i in range(arg_data.numberOfFlagUses(self.frames_flag))]
+        
+        if arg_data.isFlagSet(self.index_flag):
+            self.index_arg = [arg_data.getFlagArgumentList(self.index_flag, i).asInt(0)
+                              for i in range(arg_data.numberOfFlagUses(self.index_flag))]
+        
+        if arg_data.isFlagSet(self.tick_flag):
+            self.tick_arg = arg_data.flagArgumentBool(self.tick_flag, 0)
+        
+        if arg_data.isFlagSet(self.stride_flag):
+            self.stride_arg = arg_data.flagArgumentDouble(self.stride_flag, 0)
+        
+        if arg_data.isFlagSet(self.time_range_flag):
+            self.time_range_arg = (arg_data.flagArgumentDouble(self.time_range_flag, 0),
+                                   arg_data.flagArgumentDouble(self.time_range_flag, 1))
+        
         return arg_data.numberOfFlagsUsed
     
+    def get_mode(self):
+        if self.mode_arg is not None:
+            return options.BlendingMode.get_mode_from_name(self.mode_arg)
+        
+        return options.BlendingMode.get_mode_from_id(self.type_arg)
+    
+    def get_stride_times(self):
+        """
+        Gets every stride frame in the time range flag, the selected time slider range or the playback range.
+        """
+        if self.time_range_arg is not None:
+            start, end = self.time_range_arg
+        else:
+            start, end = utils.get_time_slider_range()
+            if start == end:
+                unit = om.MTime.uiUnit()
+                start = oma.MAnimControl.minTime().asUnits(unit)
+                end = oma.MAnimControl.maxTime().asUnits(unit)
+        
+        return animdata.get_stride_times(start, end, self.stride_arg)
+    
+    def prepare_explicit(self, mode):
+        """
+        Prepares the curves from the explicit target flags. Only the current time is read when no frames or indices
+        are given, selection is only read when no curves are given.
+        """
+        if self.curves_arg is not None:
+            curves = utils.get_anim_curves_from_names(self.curves_arg)
+            plugs = None
+        else:
+            curves, plugs = animdata.get_target_curves()
+        
+        curve_fns = [oma.MFnAnimCurve(curve) for curve in curves]
+        
+        if self.index_arg is not None:
+            animdata.prepare_indices(curve_fns, self.index_arg, mode, plugs)
+        elif self.frames_arg is not None:
+            animdata.prepare_times(curve_fns, self.frames_arg, mode, plugs)
+        elif self.stride_arg is not None:
+            animdata.prepare_times(curve_fns, self.get_stride_times(), mode, plugs)
+        else:
+            current_time = oma.MAnimControl.currentTime().asUnits(om.MTime.uiUnit())
+            animdata.prepare_times(curve_fns, [current_time], mode, plugs)
+    
     def doIt(self, args):
         # pass arguments, and if 0 flags are given, show the window
         if self.pass_args(args) == 0:
-            ui.show()
+            load_ui().show()
+            return
+        
+        # a key hammer job running in the background would key with indices from before this command
+        keyhammer.finish_job()
+        
+        # only set the tick color
+        if self.tick_arg is not None:
+            self.tick_modifier = om.MDGModifier()
+            tween.tick_draw_special(special=self.tick_arg, modifier=self.tick_modifier)
             return
         
+        mode = self.get_mode()
+        is_explicit = (self.curves_arg is not None or self.frames_arg is not None or self.index_arg is not None or
+                       self.stride_arg is not None)
+        
         # the animation cache must be stored in the command instance itself so
         # we pass a reference to the cache to the Lt class, so we can manipulate
         # the currently active cache
-        if self.new_cache_arg:
+        if self.new_cache_arg or is_explicit:
             # initialize, then create a new cache
             self.anim_cache = oma.MAnimCurveChange()
             animdata.anim_cache = self.anim_cache
-            animdata.prepare(mode=options.BlendingMode.get_mode_from_id(self.type_arg))
+            self.tick_modifier = om.MDGModifier()
+            animdata.tick_modifier = self.tick_modifier
+            
+            if is_explicit:
+                self.prepare_explicit(mode)
+            else:
+                animdata.prepare(mode=mode)
         
         # always interpolate
         self.anim_cache = animdata.anim_cache
-        tween.interpolate(blend=self.blend_arg, mode=options.BlendingMode.get_mode_from_id(self.type_arg))
+        self.tick_modifier = animdata.tick_modifier
+        tween.interpolate(blend=self.blend_arg, mode=mode)
     
     def redoIt(self):
-        self.anim_cache.redoIt()
+        if self.anim_cache is not None:
+            self.anim_cache.redoIt()
+        
+        if self.tick_modifier is not None:
+            self.tick_modifier.doIt()
     
     def undoIt(self):
-        self.anim_cache.undoIt()
+        if self.tick_modifier is not None:
+            self.tick_modifier.undoIt()
+        
+        if self.anim_cache is not None:
+            self.anim_cache.undoIt()
     
     def isUndoable(*args, **kwargs):
         return True
@@ -301,10 +495,10 @@ class TweenerUICmd(om.MPxCommand):
     def doIt(self, args):
         # pass arguments, and if 0 flags are given, show the window
         if self.pass_args(args) == 0:
-            ui.show()
+            load_ui().show()
             return
         
-        ui.show(restore=self.restore_arg)
+        load_ui().show(restore=self.restore_arg)
     
     def isUndoable(*args, **kwargs):
         return False
@@ -317,6 +511,26 @@ class KeyHammerCmd(om.MPxCommand):
     
     cmd_name = 'keyHammer'
     anim_cache = None
+    job = None
+    
+    # command flags
+    preserve_shape_flag = '-ps'
+    preserve_shape_flag_long = '-preserveShape'
+    background_flag = '-bg'
+    background_flag_long = '-background'
+    layer_scope_flag = '-ls'
+    layer_scope_flag_long = '-layerScope'
+    channelbox_flag = '-cb'
+    channelbox_flag_long = '-channelBox'
+    dry_run_flag = '-dr'
+    dry_run_flag_long = '-dryRun'
+    
+    # default command argument values
+    preserve_shape_arg = False
+    background_arg = False
+    layer_scope_arg = keyhammer.LAYER_SCOPE_BEST
+    channelbox_arg = True
+    query_arg = False
     
     def __init__(self):
         om.MPxCommand.__init__(self)
@@ -325,20 +539,93 @@ class KeyHammerCmd(om.MPxCommand):
     def cmd_creator():
         return KeyHammerCmd()
     
+    @classmethod
+    def syntax_creator(cls):
+        syntax = om.MSyntax()
+        syntax.addFlag(cls.preserve_shape_flag, cls.preserve_shape_flag_long, om.MSyntax.kBoolean)
+        syntax.addFlag(cls.background_flag, cls.background_flag_long, om.MSyntax.kBoolean)
+        syntax.addFlag(cls.layer_scope_flag, cls.layer_scope_flag_long, om.MSyntax.kString)
+        syntax.addFlag(cls.channelbox_flag, cls.channelbox_flag_long, om.MSyntax.kBoolean)
+        syntax.addFlag(cls.dry_run_flag, cls.dry_run_flag_long, om.MSyntax.kBoolean)
+        
+        # query mode is a dry run, which returns the keys that would be added.
+        # the layer scope and channel box flags keep their arguments when querying
+        syntax.enableQuery = True
+        syntax.makeFlagQueryWithFullArgs(cls.layer_scope_flag, False)
+        syntax.makeFlagQueryWithFullArgs(cls.channelbox_flag, False)
+        return syntax
+    
+    def pass_args(self, args):
+        arg_data = om.MArgParser(self.syntax(), args)
+        self.query_arg = arg_data.isQuery
+        
+        if arg_data.isFlagSet(self.layer_scope_flag):
+            self.layer_scope_arg = arg_data.flagArgumentString(self.layer_scope_flag, 0)
+        
+        if arg_data.isFlagSet(self.channelbox_flag):
+            self.channelbox_arg = arg_data.flagArgumentBool(self.channelbox_flag, 0)
+        
+        # in query mode -ps has no argument, so it means estimating the shape preserving mode
+        if self.query_arg:
+            self.preserve_shape_arg = arg_data.isFlagSet(self.preserve_shape_flag)
+            return arg_data.numberOfFlagsUsed
+        
+        if arg_data.isFlagSet(self.dry_run_flag):
+            self.query_arg = arg_data.flagArgumentBool(self.dry_run_flag, 0)
+        
+        if arg_data.isFlagSet(self.preserve_shape_flag):
+            self.preserve_shape_arg = arg_data.flagArgumentBool(self.preserve_shape_flag, 0)
+        
+        if arg_data.isFlagSet(self.background_flag):
+            self.background_arg = arg_data.flagArgumentBool(self.background_flag, 0)
+        
+        return arg_data.numberOfFlagsUsed
+    
     def doIt(self, args):
+        self.pass_args(args)
+        keyhammer.finish_job()
+        
+        # dry run, returns the estimate as a json string
+        if self.query_arg:
+            self.clearResult()
+            self.setResult(json.dumps(keyhammer.estimate(preserve_shape=self.preserve_shape_arg,
+                                                         layer_scope=self.layer_scope_arg,
+                                                         use_channelbox=self.channelbox_arg)))
+            return
+        
         self.anim_cache = oma.MAnimCurveChange()
         animdata.anim_cache = self.anim_cache
         self.clearResult()
-        self.setResult(keyhammer.do())
+        self.setResult(keyhammer.do(preserve_shape=self.preserve_shape_arg,
+                                    background=self.background_arg,
+                                    layer_scope=self.layer_scope_arg,
+                                    use_channelbox=self.channelbox_arg))
+        
+        # keep the job, so it can be stopped if the command is undone while it is running
+        self.job = keyhammer.current_job
     
     def redoIt(self):
+        if self.job is not None and self.job.rolled_back:
+            return  # cancelled from the progress bar, the keys were already removed
+        
+        if self.job is not None and self.job.cancelled:
+            count = self.job.key_count
+            sys.stdout.write('# Keyhammer was stopped before it finished, redo only adds the %d key%s added before\n' %
+                             (count, '' if count == 1 else 's'))
+        
         self.anim_cache.redoIt()
     
     def undoIt(self):
+        if self.job is not None and not self.job.is_done:
+            self.job.cancel()
+        
+        if self.job is not None and self.job.rolled_back:
+            return
+        
         self.anim_cache.undoIt()
     
-    def isUndoable(*args, **kwargs):
-        return True
+    def isUndoable(self, *args, **kwargs):
+        return not self.query_arg
     
     def __str__(self):
         return self.cmd_name
@@ -359,4 +646,4 @@ class TweenerToolCmd(om.MPxCommand):
         return TweenerToolCmd()
     
     def doIt(self, args):
-        tool.activate()
+        load_tool().activate()